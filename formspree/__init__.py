@@ -15,4 +15,7 @@ def debuggable_app():
 
     return app
 
-from . import manage
+# the cli commands (and their dependencies) are only needed by `flask`
+import os
+if os.getenv('FLASK_RUN_FROM_CLI'):
+    from . import manage
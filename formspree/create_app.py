@@ -1,4 +1,5 @@
 import json
+import time
 import structlog
 
 from flask import Flask, g, request, url_for, redirect, jsonify
@@ -8,7 +9,9 @@ from flask_limiter.util import get_ipaddr
 
 from . import routes, settings
 from .utils import request_wants_json
-from .stuff import DB, redis_store, cdn, celery
+from .stuff import DB, redis_store, cdn, celery, TEMPLATES
+from .template import configure_inlined_templates
+from .forms import archive
 from .users.models import User
 
 
@@ -89,16 +92,37 @@ def configure_logger(app):
         g.log = logger.new()
 
 
+# how long each step of the last create_app call took, see startup-profile.
+STARTUP_TIMINGS = []
+
+
 def create_app():
+    started = time.perf_counter()
+    STARTUP_TIMINGS[:] = []
+
+    def step(name):
+        nonlocal started
+        now = time.perf_counter()
+        STARTUP_TIMINGS.append((name, now - started))
+        started = now
+
     app = Flask(__name__)
     app.config.from_object(settings)
+    step('flask')
 
     DB.init_app(app)
     redis_store.init_app(app)
+    step('extensions')
+    # segments of the cold archive are shared by the web and the worker.
+    # the build has neither Redis nor the store.
+    if not settings.BUILDING:
+        archive.check_store()
     routes.configure_routes(app)
+    step('routes')
     configure_login(app)
     configure_logger(app)
-
+    configure_inlined_templates(app, TEMPLATES)
+    step('login, logger and templates')
 
     app.jinja_env.filters['json'] = json.dumps
 
@@ -115,6 +139,7 @@ def create_app():
     app.config['CDN_DOMAIN'] = settings.CDN_URL
     app.config['CDN_HTTPS'] = True
     cdn.init_app(app)
+    step('jinja and cdn')
 
     celery.conf.update(app.config)
     class ContextTask(celery.Task):
@@ -124,6 +149,7 @@ def create_app():
                     g.log = structlog.get_logger().new()
                     return self.run(*args, **kwargs)
     celery.Task = ContextTask
+    step('celery')
 
     if not app.debug and not app.testing:
         configure_ssl_redirect(app)
@@ -134,5 +160,6 @@ def create_app():
         global_limits=[settings.RATE_LIMIT],
         storage_uri=settings.REDIS_RATE_LIMIT
     )
+    step('rate limiter')
 
     return app
@@ -8,9 +8,11 @@ from flask_login import current_user, login_required
 from formspree import settings
 from formspree.stuff import DB
 from formspree.utils import jsonerror, IS_VALID_EMAIL
+from formspree.template import TemplateRenderError
 from .helpers import referrer_to_path, sitewide_file_check, remove_www, \
                      referrer_to_baseurl
-from .models import Form, Submission, EmailTemplate
+from .models import Form, Submission, EmailTemplate, ArchiveSegment
+from . import archive, counters as form_counters
 
 
 @login_required
@@ -18,8 +20,10 @@ def list():
     # grab all the forms this user controls
     if current_user.has_feature('dashboard'):
         forms = current_user.forms.order_by(Form.id.desc()).all()
+        pending = form_counters.pending(*[f.id for f in forms])
     else:
         forms = []
+        pending = {}
 
     return jsonify({
         'ok': True,
@@ -27,7 +31,7 @@ def list():
             'features': {f: True for f in current_user.features},
             'email': current_user.email
         },
-        'forms': [f.serialize() for f in forms]
+        'forms': [f.serialize(pending_counter=pending[f.id]) for f in forms]
     })
 
 
@@ -109,15 +113,91 @@ def get(hashid):
     if not form.controlled_by(current_user):
         return jsonerror(401, {'error': "You do not control this form."})
 
-    submissions, fields = form.submissions_with_fields()
-
     ret = form.serialize()
-    ret['submissions'] = submissions
-    ret['fields'] = fields
+
+    # the dashboard fetches submissions page by page from fa.submissions
+    if request.args.get('submissions') != 'false':
+        submissions, fields = form.submissions_with_fields()
+        ret['submissions'] = submissions
+        ret['fields'] = fields
 
     return jsonify(ret)
 
 
+@login_required
+def submissions(hashid):
+    if not current_user.has_feature('dashboard'):
+        return jsonerror(402, {'error': "Please upgrade your account."})
+
+    form = Form.get_with_hashid(hashid)
+    if not form:
+        return jsonerror(404, {'error': "Form not found."})
+
+    if not form.controlled_by(current_user):
+        return jsonerror(401, {'error': "You do not control this form."})
+
+    # invalid values fall back to the defaults
+    limit = request.args.get('limit', settings.SUBMISSIONS_PAGE_SIZE, type=int)
+    before = request.args.get('before', type=int)
+    since = request.args.get('since', type=int)
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+
+    # ?where.email=alice@example.com only returns submissions with that email
+    where = {key[len('where.'):]: value
+             for key, value in request.args.items()
+             if key.startswith('where.') and len(key) > len('where.')}
+
+    submissions, fields, next = form.submissions_page(
+        limit=max(1, min(limit, settings.SUBMISSIONS_PAGE_MAX)),
+        before=before,
+        since=since,
+        fields=fields,
+        where=where
+    )
+
+    return jsonify({
+        'ok': True,
+        'submissions': submissions,
+        'fields': fields,
+        'next': next
+    })
+
+
+@login_required
+def search(hashid):
+    if not current_user.has_feature('dashboard'):
+        return jsonerror(402, {'error': "Please upgrade your account."})
+
+    form = Form.get_with_hashid(hashid)
+    if not form:
+        return jsonerror(404, {'error': "Form not found."})
+
+    if not form.controlled_by(current_user):
+        return jsonerror(401, {'error': "You do not control this form."})
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonerror(400, {'error': "Nothing to search for."})
+
+    limit = request.args.get('limit', settings.SUBMISSIONS_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    submissions, next = form.search_submissions(
+        q,
+        limit=max(1, min(limit, settings.SUBMISSIONS_PAGE_MAX)),
+        offset=max(0, offset)
+    )
+
+    return jsonify({
+        'ok': True,
+        'submissions': submissions,
+        'fields': form.submission_fields(),
+        'next': next
+    })
+
+
 @login_required
 def update(hashid):
     # check that this request came from user dashboard to prevent XSS and CSRF
@@ -159,11 +239,19 @@ def delete(hashid):
     if form.owner_id != current_user.id and form not in current_user.forms:
         return jsonerror(401, {'error': 'Wrong user.'})
 
+    segments = [key for key, in DB.session.query(ArchiveSegment.key)
+                .filter(ArchiveSegment.form_id == form.id)]
+
     for submission in form.submissions:
         DB.session.delete(submission)
     DB.session.delete(form)
     DB.session.commit()
 
+    # the segments' index entries are gone with the form.
+    if segments and archive.store():
+        for key in segments:
+            archive.store().delete(key)
+
     return jsonify({'ok': True})
 
 
@@ -182,14 +270,15 @@ def submission_delete(hashid, submissionid):
     if form.owner_id != current_user.id and form not in current_user.forms:
         return jsonerror(401, {'error': 'Wrong user.'})
 
-    submission = Submission.query.get(submissionid)
+    submission = Submission.query \
+        .filter_by(id=submissionid, form_id=form.id) \
+        .first()
     if not submission:
         return jsonerror(401, 'Not a valid submission.')
 
     DB.session.delete(submission)
-    form.counter -= 1
-    DB.session.add(form)
     DB.session.commit()
+    form_counters.add(form.id, -1)
     return jsonify({'ok': True})
 
 
@@ -213,8 +302,8 @@ def custom_template_set(hashid):
 
     try:
         template.sample()
-    except Exception as e:
-        print(e)
+    except TemplateRenderError as e:
+        g.log.info('Failed to render custom template.', error=str(e))
         return jsonerror(406, {'error': "Failed to render. The template has errors."})
 
     DB.session.add(template)
@@ -0,0 +1,161 @@
+import io
+import os
+import json
+import uuid
+from urllib.parse import urlparse
+
+from formspree import settings
+from formspree.stuff import redis_store
+
+# old submissions of paying forms are moved out of Postgres, instead of
+# being deleted, into zstd compressed ndjson segments kept by a store
+# (see settings.SUBMISSIONS_ARCHIVE_STORE) and indexed in archive_segments.
+# segments are written by the worker, and read and deleted by the web
+# processes, so all of them must see the same store.
+
+# the token of the marker file of the local store first seen by a process.
+REDIS_ARCHIVE_MARKER_KEY = 'archive_store_marker'
+
+
+class LocalStore(object):
+    '''
+    Keeps segments as files under a directory, which must be shared by
+    every process (a network volume), see `check`.
+    '''
+
+    MARKER = '.formspree-archive'
+
+    def __init__(self, url):
+        self.root = urlparse(url).path
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, blob):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def check(self):
+        '''
+        Fails unless this process sees the same directory as the first one
+        that checked it: the directory holds a marker file with a random
+        token, that the first process also keeps on Redis.
+        '''
+        path = self._path(self.MARKER)
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            with open(path, 'x') as f:
+                f.write(uuid.uuid4().hex)
+        except FileExistsError:
+            pass
+        with open(path) as f:
+            token = f.read().strip()
+
+        redis_store.set(REDIS_ARCHIVE_MARKER_KEY, token, nx=True)
+        if redis_store.get(REDIS_ARCHIVE_MARKER_KEY).decode('utf-8') != token:
+            raise RuntimeError(
+                'The archive store %s is not shared with the other processes. '
+                'Mount the same volume on every dyno, or use an s3:// store.'
+                % self.root)
+
+
+class S3Store(object):
+    '''
+    Keeps segments in an S3 bucket, under the url's path, like
+    's3://bucket/archive'. Credentials come from the usual AWS variables.
+    '''
+
+    def __init__(self, url):
+        import boto3
+
+        url = urlparse(url)
+        self.bucket = url.netloc
+        self.prefix = url.path.strip('/')
+        self.client = boto3.client('s3')
+
+    def _key(self, key):
+        return '%s/%s' % (self.prefix, key) if self.prefix else key
+
+    def put(self, key, blob):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=blob)
+
+    def open(self, key):
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+        return io.BytesIO(body.read())
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def check(self):
+        pass
+
+
+# stores by url scheme. others only need put(key, bytes), open(key) -> file
+# object, delete(key) and check(), that fails when the store can't be used.
+STORES = {
+    'file': LocalStore,
+    's3': S3Store
+}
+
+_store = {}
+
+
+def store():
+    '''The configured store, or None when old submissions are deleted.'''
+    url = settings.SUBMISSIONS_ARCHIVE_STORE
+    if not url:
+        return None
+    if _store.get('url') != url:
+        _store.update(url=url, store=STORES[urlparse(url).scheme](url))
+    return _store['store']
+
+
+def check_store():
+    '''Run at startup, so a misconfigured store stops the process.'''
+    if store() is not None:
+        store().check()
+
+
+def segment_key(form_id, first_id, last_id):
+    return 'forms/{form_id}/{first_id}-{last_id}.ndjson.zst'.format(
+        form_id=form_id, first_id=first_id, last_id=last_id)
+
+
+def compress(submissions):
+    '''
+    A segment with these submissions, formatted like Form.iter_submissions,
+    one json object per line.
+    '''
+    import zstandard
+
+    lines = ''.join(json.dumps(sub, sort_keys=True) + '\n'
+                    for sub in submissions)
+    return zstandard.ZstdCompressor(level=settings.SUBMISSIONS_ARCHIVE_LEVEL) \
+        .compress(lines.encode('utf-8'))
+
+
+def read(key):
+    '''
+    The submissions in a segment. Segments hold at most a retention batch
+    (settings.RETENTION_BATCH_SIZE), so they're decompressed whole.
+    '''
+    import zstandard
+
+    with store().open(key) as f:
+        lines = zstandard.ZstdDecompressor().decompress(f.read())
+    return [json.loads(line) for line in lines.decode('utf-8').splitlines()]
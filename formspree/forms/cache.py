@@ -0,0 +1,238 @@
+import json
+import time
+from collections import OrderedDict
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from flask_sqlalchemy import SignallingSession
+
+from formspree import settings
+from formspree.stuff import DB, redis_store
+from formspree.utils import BloomFilter
+from formspree.forms.quota import clear_hard_overlimit
+
+REDIS_CONTROLLERS_KEY = 'controllers_{form_id}'.format
+REDIS_FORM_KEY = 'form_{form_id}'.format
+REDIS_MISSING_FORM_KEY = 'missing_form_{form_id}'.format
+# names already in the fields catalog of a form (see FormField).
+REDIS_FORM_FIELDS_KEY = 'form_fields_{form_id}'.format
+REDIS_FORMS_FILTER_KEY = 'forms_filter'
+REDIS_FORMS_FILTER_VERSION_KEY = 'forms_filter_version'
+REDIS_FORMS_FILTER_STATS_KEY = 'forms_filter_stats'
+
+# a form's hash never changes, so hash -> id is kept in process memory.
+_form_ids_by_hash = OrderedDict()
+
+# this process' copy of the filter of existing form ids, see forms_filter.
+_forms_filter = {'filter': None, 'watermark': 0,
+                 'version': None, 'checked_at': 0}
+
+
+def request_memo(name):
+    '''
+    A dict that lives as long as the current request (or celery task),
+    or a throwaway one when there's no app context.
+    '''
+    if not has_app_context():
+        return {}
+    return g.setdefault('_memo_' + name, {})
+
+
+def form_controllers(form):
+    '''
+    The ids and the union of the plan features of all users that control
+    this form. Memoized for the current request and cached on Redis across
+    requests, until the controllers or their plans change (see the
+    invalidation listeners in users/models.py).
+    '''
+    if form.id is None:
+        return {'ids': [], 'features': []}
+
+    memo = request_memo('controllers')
+    if form.id in memo:
+        return memo[form.id]
+
+    key = REDIS_CONTROLLERS_KEY(form_id=form.id)
+    cached = redis_store.get(key)
+    if cached is not None:
+        resolved = json.loads(cached.decode('utf-8'))
+    else:
+        users = form.controllers.all()
+        resolved = {
+            'ids': [user.id for user in users],
+            'features': sorted(set().union(*[user.features for user in users]))
+        }
+        redis_store.set(key, json.dumps(resolved),
+                        ex=settings.CONTROLLERS_CACHE_TTL)
+
+    memo[form.id] = resolved
+    return resolved
+
+
+def form_id_for_hash(hash):
+    try:
+        _form_ids_by_hash.move_to_end(hash)
+        return _form_ids_by_hash[hash]
+    except KeyError:
+        return None
+
+
+def remember_form_hash(hash, form_id):
+    _form_ids_by_hash[hash] = form_id
+    while len(_form_ids_by_hash) > settings.FORM_HASH_CACHE_SIZE:
+        _form_ids_by_hash.popitem(last=False)
+
+
+def get_form_snapshot(form_id):
+    '''
+    Fetches, in a single round trip, the cached columns of a form, its
+    cached controllers and whether it was recently found not to exist.
+    The controllers go straight to the request memo used by
+    form_controllers. Returns (snapshot, missing).
+    '''
+    snapshot, controllers, missing = redis_store.mget([
+        REDIS_FORM_KEY(form_id=form_id),
+        REDIS_CONTROLLERS_KEY(form_id=form_id),
+        REDIS_MISSING_FORM_KEY(form_id=form_id)
+    ])
+    if controllers is not None:
+        request_memo('controllers')[form_id] = \
+            json.loads(controllers.decode('utf-8'))
+    if snapshot is not None:
+        snapshot = json.loads(snapshot.decode('utf-8'))
+    return snapshot, missing is not None
+
+
+def store_form_snapshot(snapshot):
+    redis_store.set(REDIS_FORM_KEY(form_id=snapshot['id']),
+                    json.dumps(snapshot), ex=settings.FORM_CACHE_TTL)
+
+
+def new_form_fields(form_id, names):
+    '''
+    The names, in the same order, that aren't known to be in the fields
+    catalog of this form, in a single round trip.
+    '''
+    key = REDIS_FORM_FIELDS_KEY(form_id=form_id)
+    pipe = redis_store.pipeline(transaction=False)
+    for name in names:
+        pipe.sismember(key, name)
+    return [name for name, known in zip(names, pipe.execute()) if not known]
+
+
+def remember_form_fields_after_commit(session, form_id, names):
+    '''
+    Marks these names as known to be in the fields catalog of this form,
+    once the current transaction that adds them is committed.
+    '''
+    session.info.setdefault('recorded_fields', {}) \
+        .setdefault(form_id, set()).update(names)
+
+
+def remember_missing_form(form_id):
+    redis_store.set(REDIS_MISSING_FORM_KEY(form_id=form_id), 1,
+                    ex=settings.MISSING_FORM_TTL)
+
+
+def store_forms_filter(bloom, watermark):
+    '''
+    Publishes a filter of the ids of all existing forms up to `watermark`
+    to every process.
+    '''
+    version = str(time.time())
+    pipe = redis_store.pipeline()
+    pipe.set(REDIS_FORMS_FILTER_KEY,
+             str(watermark).encode('utf-8') + b':' + bloom.to_bytes())
+    pipe.set(REDIS_FORMS_FILTER_VERSION_KEY, version)
+    pipe.execute()
+
+
+def forms_filter():
+    '''
+    The latest filter of existing form ids, checked for updates at most
+    every FORMS_FILTER_REFRESH seconds. Returns (filter, watermark), the
+    filter being None when none was built yet.
+    '''
+    now = time.time()
+    if now - _forms_filter['checked_at'] > settings.FORMS_FILTER_REFRESH:
+        _forms_filter['checked_at'] = now
+        version = redis_store.get(REDIS_FORMS_FILTER_VERSION_KEY)
+        if version != _forms_filter['version']:
+            data = redis_store.get(REDIS_FORMS_FILTER_KEY)
+            if data:
+                watermark, bloom = data.split(b':', 1)
+                _forms_filter.update(
+                    filter=BloomFilter.from_bytes(bloom),
+                    watermark=int(watermark),
+                    version=version
+                )
+    return _forms_filter['filter'], _forms_filter['watermark']
+
+
+def form_surely_missing(form_id):
+    '''
+    True when the filter of existing forms rules out this id. Ids beyond
+    the filter's watermark (created after it was built) are never ruled out.
+    '''
+    bloom, watermark = forms_filter()
+    return bloom is not None and form_id <= watermark \
+        and str(form_id) not in bloom
+
+
+def count_missing_form_lookup(how):
+    '''
+    Counts lookups for forms that don't exist, by how they were answered:
+    'filter', 'negative_cache' or 'database'.
+    '''
+    redis_store.hincrby(REDIS_FORMS_FILTER_STATS_KEY, how, 1)
+
+
+def invalidate_forms(*form_ids):
+    '''
+    Drops everything cached about these forms, in Redis and in the
+    current request.
+    '''
+    if not form_ids:
+        return
+
+    redis_store.delete(*[key(form_id=id) for id in form_ids
+                         for key in (REDIS_CONTROLLERS_KEY, REDIS_FORM_KEY,
+                                     REDIS_MISSING_FORM_KEY,
+                                     REDIS_FORM_FIELDS_KEY)])
+    # forms may have been upgraded to unlimited submissions.
+    clear_hard_overlimit(*form_ids)
+
+    memo = request_memo('controllers')
+    for id in form_ids:
+        memo.pop(id, None)
+
+
+def invalidate_forms_after_commit(session, *form_ids):
+    '''
+    Same as invalidate_forms, but waits for the current transaction to be
+    committed, so concurrent requests can't cache the old state again.
+    To be called from inside flushes.
+    '''
+    session.info.setdefault('invalidated_forms', set()).update(form_ids)
+
+
+# DB.session is a scoped_session, that can't have listeners with this
+# version of Flask-SQLAlchemy, so they're on the class of its sessions.
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_committed_forms(session):
+    invalidate_forms(*session.info.pop('invalidated_forms', ()))
+
+    recorded = session.info.pop('recorded_fields', {})
+    if recorded:
+        pipe = redis_store.pipeline(transaction=False)
+        for form_id, names in recorded.items():
+            key = REDIS_FORM_FIELDS_KEY(form_id=form_id)
+            pipe.sadd(key, *names)
+            pipe.expire(key, settings.FORM_CACHE_TTL)
+        pipe.execute()
+
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def forget_invalidated_forms(session, previous_transaction):
+    session.info.pop('invalidated_forms', None)
+    session.info.pop('recorded_fields', None)
@@ -0,0 +1,124 @@
+import uuid
+
+from formspree.stuff import redis_store, DB
+
+# submissions counted since the last flush, by form id.
+REDIS_PENDING_COUNTERS_KEY = 'form_counters_pending'
+# counts taken by a flush that wasn't committed to Postgres yet.
+REDIS_FLUSHING_COUNTERS_KEY = 'form_counters_flushing'
+# the same for the counts of the fields catalog (see FormField), by
+# '<form id>:<field name>'.
+REDIS_PENDING_FIELDS_KEY = 'form_fields_pending'
+REDIS_FLUSHING_FIELDS_KEY = 'form_fields_flushing'
+# identifies the counts being flushed. recorded in counter_flushes in the
+# transaction that adds them to Postgres, so they're never added twice.
+REDIS_FLUSH_ID_KEY = 'form_counters_flush_id'
+REDIS_FLUSH_LOCK_KEY = 'form_counters_flush_lock'
+
+# moves the pending counts into the flushing hashes under a new flush id,
+# unless a failed flush left some there, and returns what is to be flushed:
+# the flush id (nil when there's nothing) and both hashes.
+# KEYS: pending counters, flushing counters, pending fields, flushing
+#       fields, flush id
+# ARGV: new flush id
+TAKE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[5]) == 0 then
+    local moved = false
+    for _, i in ipairs({1, 3}) do
+        if redis.call('EXISTS', KEYS[i]) == 1 then
+            redis.call('RENAME', KEYS[i], KEYS[i + 1])
+            moved = true
+        end
+    end
+    if moved then
+        redis.call('SET', KEYS[5], ARGV[1])
+    end
+end
+return {redis.call('GET', KEYS[5]),
+        redis.call('HGETALL', KEYS[2]),
+        redis.call('HGETALL', KEYS[4])}
+'''
+
+_scripts = {}
+
+
+def add(form_id, delta=1):
+    redis_store.hincrby(REDIS_PENDING_COUNTERS_KEY, form_id, delta)
+
+
+def add_fields(form_id, names):
+    pipe = redis_store.pipeline(transaction=False)
+    for name in names:
+        pipe.hincrby(REDIS_PENDING_FIELDS_KEY, '%s:%s' % (form_id, name), 1)
+    pipe.execute()
+
+
+def pending(*form_ids):
+    '''
+    How much the counters of these forms changed since they were last
+    flushed to Postgres, in a single round trip. Returns a dict.
+    '''
+    ids = [id for id in form_ids if id is not None]
+    if not ids:
+        return {id: 0 for id in form_ids}
+
+    pipe = redis_store.pipeline()
+    pipe.hmget(REDIS_PENDING_COUNTERS_KEY, ids)
+    pipe.hmget(REDIS_FLUSHING_COUNTERS_KEY, ids)
+    pipe.get(REDIS_FLUSH_ID_KEY)
+    pending, flushing, flush_id = pipe.execute()
+    # a flush that was committed, but not cleared from Redis yet, is already
+    # in the stored counters.
+    if any(flushing) and is_flushed(flush_id):
+        flushing = [None] * len(ids)
+    counts = {id: int(p or 0) + int(f or 0)
+              for id, p, f in zip(ids, pending, flushing)}
+    return {id: counts.get(id, 0) for id in form_ids}
+
+
+def flush_lock(timeout):
+    '''Held while flushing, so flushes don't overlap.'''
+    return redis_store.lock(REDIS_FLUSH_LOCK_KEY, timeout=timeout,
+                            blocking_timeout=timeout)
+
+
+def take():
+    '''
+    The counts to be flushed, as (flush id, {form id: delta}, {(form id,
+    field name): delta}). The flush id is None when there's nothing to
+    flush. The counts keep being counted by `pending` until `flushed` is
+    called, and are taken again, with the same id, until then.
+    '''
+    if 'take' not in _scripts:
+        _scripts['take'] = redis_store.register_script(TAKE_SCRIPT)
+    flush_id, counters, fields = _scripts['take'](
+        keys=[REDIS_PENDING_COUNTERS_KEY, REDIS_FLUSHING_COUNTERS_KEY,
+              REDIS_PENDING_FIELDS_KEY, REDIS_FLUSHING_FIELDS_KEY,
+              REDIS_FLUSH_ID_KEY],
+        args=[uuid.uuid4().hex])
+    if flush_id is None:
+        return None, {}, {}
+
+    counters = {int(counters[i]): int(counters[i + 1])
+                for i in range(0, len(counters), 2)}
+    field_counts = {}
+    for i in range(0, len(fields), 2):
+        form_id, name = fields[i].decode('utf-8').split(':', 1)
+        field_counts[(int(form_id), name)] = int(fields[i + 1])
+    return flush_id.decode('utf-8'), counters, field_counts
+
+
+def is_flushed(flush_id):
+    '''Whether the counts taken under `flush_id` were committed.'''
+    if not flush_id:
+        return False
+    if isinstance(flush_id, bytes):
+        flush_id = flush_id.decode('utf-8')
+    return DB.session.execute(
+        'SELECT 1 FROM counter_flushes WHERE id = :id', {'id': flush_id}
+    ).scalar() is not None
+
+
+def flushed():
+    redis_store.delete(REDIS_FLUSHING_COUNTERS_KEY, REDIS_FLUSHING_FIELDS_KEY,
+                       REDIS_FLUSH_ID_KEY)
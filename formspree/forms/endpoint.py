@@ -1,4 +1,5 @@
 import json
+from functools import wraps
 from urllib.parse import urljoin
 
 from flask import request, render_template, redirect, \
@@ -16,8 +17,10 @@ from formspree.forms.helpers import http_form_to_dict, ordered_storage, \
                                     referrer_to_path, remove_www, \
                                     verify_captcha, temp_store_hostname, \
                                     get_temp_hostname, HASH, assign_ajax, \
-                                    KEYS_EXCLUDED_FROM_EMAIL
+                                    KEYS_EXCLUDED_FROM_EMAIL, HASHIDS_CODEC
 from formspree.forms.models import Form
+from formspree.forms.cache import form_id_for_hash
+from formspree.forms.quota import is_hard_overlimit
 
 
 def get_host_and_referrer(received_data):
@@ -41,13 +44,27 @@ def get_host_and_referrer(received_data):
         ), 500))
 
 
+def known_form_id(email_or_string, host):
+    '''
+    The id of the form a submission is for, when it can be found without
+    querying the database, or None.
+    '''
+    if IS_VALID_EMAIL(email_or_string):
+        return form_id_for_hash(HASH(email_or_string.lower(), host))
+
+    try:
+        return HASHIDS_CODEC.decode(email_or_string)[0]
+    except IndexError:
+        return None
+
+
 def validate_user_form(hashid, host):
     '''
     Gets a form from a hashid, created on the dashboard. 
     Checks to make sure the submission can be accepted by this form.
     '''
 
-    form = Form.get_with_hashid(hashid)
+    form = Form.get_with_hashid(hashid, cached=True)
 
     if not form:
         raise SubmitFormError(errors.bad_hashid_error(hashid))
@@ -61,9 +78,9 @@ def validate_user_form(hashid, host):
     if not form.host:
         # add the host to the form
         # ALERT: As a side effect, sets the form's host if not already set
+        # (committed along with the submission, see commit_form_changes)
         form.host = host
         DB.session.add(form)
-        DB.session.commit()
 
     # it is an error when
     #   form is not sitewide, and submission came from a different host
@@ -86,7 +103,7 @@ def get_or_create_form(email, host):
     new form.
     '''
 
-    form = Form.query.filter_by(hash=HASH(email, host)).first()
+    form = Form.get_with_hash(HASH(email, host), cached=True)
 
     if not form:
 
@@ -210,9 +227,25 @@ def response_for_status(form, host, referrer, status):
     return errors.generic_send_error(send)
 
 
+def commit_form_changes(f):
+    '''
+    Changes to the form made while handling a submission (uses_ajax, host)
+    are committed with the submission or the confirmation, in a single
+    transaction. This commits them when the request ends before that.
+    '''
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        response = f(*args, **kwargs)
+        if DB.session.new or DB.session.dirty:
+            DB.session.commit()
+        return response
+    return decorator
+
+
 @cross_origin(allow_headers=['Accept', 'Content-Type',
                              'X-Requested-With', 'Authorization'])
 @ordered_storage
+@commit_form_changes
 def send(email_or_string):
     '''
     Main endpoint, finds or creates the form row from the database,
@@ -244,6 +277,12 @@ def send(email_or_string):
 
     g.log = g.log.bind(host=host, wants='json' if request_wants_json() else 'html')
 
+    # forms far over their monthly quota are turned away before any work
+    form_id = known_form_id(email_or_string, host)
+    if form_id and is_hard_overlimit(form_id):
+        g.log.info('Submission rejected. Form over quota.', form_id=form_id)
+        return errors.over_limit_error()
+
     if not IS_VALID_EMAIL(email_or_string):
         # in this case it can be a hashid identifying a
         # form generated from the dashboard
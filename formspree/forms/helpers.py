@@ -1,16 +1,23 @@
 import werkzeug.datastructures
 import requests
+import collections
+import csv
+import io
 import hashlib
 import hashids
 import uuid
 import json
+import datetime
 from urllib.parse import urljoin, urlparse
 from flask import request, g
 
 from formspree import settings
-from formspree.stuff import redis_store, DB
+from formspree.stuff import redis_store, DB, celery
+from formspree.utils import send_email, http_session, BloomFilter
 from flask import jsonify
 from flask_login import current_user
+from sqlalchemy import func
+from redis.exceptions import LockError
 
 CAPTCHA_URL = 'https://www.google.com/recaptcha/api/siteverify'
 CAPTCHA_VAL = 'g-recaptcha-response'
@@ -20,9 +27,11 @@ HASH = lambda x, y: hashlib.md5(x.encode('utf-8')+y.encode('utf-8')+settings.NON
 KEYS_NOT_STORED = {'_gotcha', '_format', '_language', CAPTCHA_VAL, '_host_nonce'}
 KEYS_EXCLUDED_FROM_EMAIL = KEYS_NOT_STORED.union({'_subject', '_cc', '_next'})
 
-REDIS_COUNTER_KEY = 'monthly_{form_id}_{month}'.format
 REDIS_HOSTNAME_KEY = 'hostname_{nonce}'.format
 REDIS_FIRSTSUBMISSION_KEY = 'first_{nonce}'.format
+REDIS_RETENTION_PENDING_KEY = 'retention_pending'
+# how zstd frames start, json never does.
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 HASHIDS_CODEC = hashids.Hashids(alphabet='abcdefghijklmnopqrstuvwxyz',
                                 min_length=8,
                                 salt=settings.HASHIDS_SALT)
@@ -78,6 +87,68 @@ def http_form_to_dict(data):
     return ret, ordered_keys
 
 
+def stored_data(data):
+    '''
+    The part of a submission that gets stored. Postgres' jsonb can't hold
+    NUL characters, so they're dropped.
+    '''
+    def clean(value):
+        if isinstance(value, str):
+            return value.replace('\x00', '')
+        if isinstance(value, dict):
+            return {clean(k): clean(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [clean(v) for v in value]
+        return value
+
+    return {clean(key): clean(value) for key, value in data.items()
+            if key not in KEYS_NOT_STORED}
+
+
+def compress(blob):
+    import zstandard
+    return zstandard.ZstdCompressor(level=settings.SUBMISSION_COMPRESS_LEVEL) \
+        .compress(blob)
+
+
+def decompress(blob):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(blob)
+
+
+def split_large_fields(data):
+    '''
+    Takes the values longer than settings.SUBMISSION_COMPRESS_THRESHOLD out
+    of a submission. Returns the rest of it, with a null placeholder for each
+    taken field so Postgres still sees its key, and the taken fields, as
+    compressed json, or None when there were none.
+    '''
+    threshold = settings.SUBMISSION_COMPRESS_THRESHOLD
+    if not threshold:
+        return data, None
+
+    large = {key: value for key, value in data.items()
+             if len(value if isinstance(value, str) else json.dumps(value)) > threshold}
+    if not large:
+        return data, None
+
+    rest = {key: None if key in large else value for key, value in data.items()}
+    return rest, compress(json.dumps(large).encode('utf-8'))
+
+
+def merge_large_fields(data, large, keys=None):
+    '''
+    Puts back the fields taken out by split_large_fields (only `keys`, when
+    given), decompressing them.
+    '''
+    if not large:
+        return data
+    fields = json.loads(decompress(bytes(large)).decode('utf-8'))
+    if keys is not None:
+        fields = {key: fields[key] for key in keys if key in fields}
+    return dict(data, **fields)
+
+
 def remove_www(host):
     if host.startswith('www.'):
         return host[4:]
@@ -92,7 +163,7 @@ def sitewide_file_check(url, email):
     g.log = g.log.bind(url=url, email=email)
 
     try:
-        res = requests.get(url, timeout=3, headers={
+        res = http_session().get(url, timeout=3, headers={
             'User-Agent': 'Mozilla/5.0 (X11; Linux i686) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/55.0.2883.87 Chrome/55.0.2883.87 Safari/537.36'
         })
         if not res.ok:
@@ -113,7 +184,7 @@ def sitewide_file_check(url, email):
 def verify_captcha(form_data, request):
     if not CAPTCHA_VAL in form_data:
         return False
-    r = requests.post(CAPTCHA_URL, data={
+    r = http_session().post(CAPTCHA_URL, data={
         'secret': settings.RECAPTCHA_SECRET,
         'response': form_data[CAPTCHA_VAL],
         'remoteip': request.remote_addr,
@@ -125,7 +196,6 @@ def assign_ajax(form, sent_using_ajax):
     if form.uses_ajax is None:
         form.uses_ajax = sent_using_ajax
         DB.session.add(form)
-        DB.session.commit()
 
 
 def temp_store_hostname(hostname, referrer):
@@ -151,7 +221,11 @@ def get_temp_hostname(nonce):
 
 def store_first_submission(nonce, data):
     key = REDIS_FIRSTSUBMISSION_KEY(nonce=nonce)
-    redis_store.set(key, json.dumps(data))
+    value = json.dumps(data).encode('utf-8')
+    if settings.SUBMISSION_COMPRESS_THRESHOLD and \
+            len(value) > settings.SUBMISSION_COMPRESS_THRESHOLD:
+        value = compress(value)
+    redis_store.set(key, value)
     redis_store.expire(key, 300000)
 
 
@@ -159,6 +233,346 @@ def fetch_first_submission(nonce):
     key = REDIS_FIRSTSUBMISSION_KEY(nonce=nonce)
     jsondata = redis_store.get(key)
     try:
+        if jsondata.startswith(ZSTD_MAGIC):
+            jsondata = decompress(jsondata)
         return json.loads(jsondata.decode('utf-8'))
     except:
         return None
+
+
+@celery.task(bind=True, max_retries=settings.OUTBOX_MAX_RETRIES)
+def deliver_outbox_email(self, outbox_id):
+    '''
+    Delivers an email queued by Form.send, retrying with exponential
+    backoff while SendGrid is failing or unreachable.
+    '''
+    from formspree.forms.models import OutboxEmail
+
+    # the row lock keeps a duplicate task from sending the same email twice
+    email = OutboxEmail.query.filter_by(id=outbox_id) \
+        .with_for_update().first()
+    if not email or email.sent_at or email.failed_at:
+        DB.session.commit()
+        return
+
+    now = datetime.datetime.utcnow()
+    email.attempts += 1
+    email.attempted_at = now
+
+    refused = False
+    try:
+        result = send_email(**email.message)
+    except requests.exceptions.RequestException as e:
+        result = (False, repr(e), None)
+    except Exception as e:
+        # a message send_email refuses, or a bug. left pending, it would be
+        # re-enqueued by drain_outbox forever.
+        result = (False, repr(e), None)
+        refused = True
+    ok, errmsg, code = result[0], result[1], result[2]
+
+    retry = False
+    if ok:
+        email.sent_at = now
+        email.error = None
+    else:
+        email.error = errmsg
+        # 4xx errors other than throttling won't go away by retrying
+        transient = not refused and \
+            (code is None or code == 429 or code >= 500)
+        if transient and email.attempts <= self.max_retries:
+            retry = True
+        else:
+            email.failed_at = now
+            g.log.warning('Giving up on outbox email.', outbox=email.id,
+                          attempts=email.attempts, code=code)
+
+    DB.session.add(email)
+    DB.session.commit()
+
+    if retry:
+        raise self.retry(countdown=settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+
+
+def enqueue_outbox_emails(emails):
+    '''
+    Hands outbox emails, once committed, to deliver_outbox_email. Those
+    that can't be enqueued are picked up later by drain_outbox.
+    '''
+    for email in emails:
+        try:
+            deliver_outbox_email.delay(email.id)
+        except Exception as e:
+            g.log.warning('Failed to enqueue outbox email.',
+                          outbox=email.id, err=repr(e))
+
+
+@celery.task()
+def drain_outbox():
+    '''
+    Periodically re-enqueues outbox emails whose delivery tasks were lost
+    (broker unavailable on enqueue, worker killed while retrying).
+    '''
+    from formspree.forms.models import OutboxEmail
+
+    before = datetime.datetime.utcnow() - \
+        datetime.timedelta(seconds=settings.OUTBOX_STALE_AFTER)
+    stale = [id for id, in OutboxEmail.stale(before).with_entities(OutboxEmail.id)]
+    for outbox_id in stale:
+        deliver_outbox_email.delay(outbox_id)
+
+    if stale:
+        g.log.info('Re-enqueued stale outbox emails.', count=len(stale))
+
+
+@celery.task()
+def rebuild_forms_filter():
+    '''
+    Rebuilds the filter of existing form ids used to reject submissions to
+    unknown hashids without a query (see Form.get_cached).
+    '''
+    from formspree.forms.models import Form
+    from formspree.forms.cache import store_forms_filter
+
+    # ids allocated by transactions still running when we scan could be
+    # committed after it, so the newest ids are left out of the filter.
+    max_id = DB.session.query(func.max(Form.id)).scalar() or 0
+    watermark = max(0, max_id - settings.FORMS_FILTER_MARGIN)
+
+    count = DB.session.query(func.count(Form.id)).scalar()
+    bloom = BloomFilter.for_capacity(max(count, 1000),
+                                     settings.FORMS_FILTER_ERROR_RATE)
+    for id, in DB.session.query(Form.id) \
+            .filter(Form.id <= watermark).yield_per(10000):
+        bloom.add(str(id))
+    DB.session.commit()
+
+    store_forms_filter(bloom, watermark)
+    g.log.info('Rebuilt forms filter.', forms=count, watermark=watermark,
+               bytes=len(bloom.bits))
+
+
+@celery.task()
+def enforce_retention():
+    '''
+    Deletes the submissions over the archive limit of the forms that got
+    new submissions since the last run, a bounded amount per run.
+    '''
+    from formspree.forms.models import Form
+
+    for _ in range(settings.RETENTION_FORMS_PER_RUN):
+        form_id = redis_store.spop(REDIS_RETENTION_PENDING_KEY)
+        if form_id is None:
+            break
+
+        form = Form.query.get(int(form_id))
+        if not form:
+            continue
+
+        try:
+            done = form.delete_submissions_over_limit(
+                settings.RETENTION_BATCH_SIZE,
+                settings.RETENTION_MAX_BATCHES
+            )
+        except:
+            DB.session.rollback()
+            redis_store.sadd(REDIS_RETENTION_PENDING_KEY, form_id)
+            raise
+
+        # forms with too many submissions to delete in one go are
+        # continued on the next run.
+        if not done:
+            redis_store.sadd(REDIS_RETENTION_PENDING_KEY, form_id)
+
+
+@celery.task()
+def flush_form_counters(blocking=False):
+    '''
+    Adds the submissions counted on Redis since the last run to the
+    counters stored on Postgres, and to the counts of the fields catalog,
+    all in one transaction. Runs one at a time, skipping the run (unless
+    `blocking`) when another one is going.
+    '''
+    from formspree.forms import counters
+    from formspree.forms.models import FormField
+
+    lock = counters.flush_lock(settings.FORM_COUNTERS_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=blocking):
+        return
+
+    try:
+        flush_id, deltas, fields = counters.take()
+        if flush_id is None:
+            return
+
+        # the counts are kept on Redis, and retried on the next run, until
+        # they're cleared after the commit. the flush id makes a retry of
+        # counts that were committed anyway a no-op.
+        now = datetime.datetime.utcnow()
+        duplicate = DB.session.execute(
+            'INSERT INTO counter_flushes (id, flushed_at) VALUES (:id, :now) '
+            'ON CONFLICT (id) DO NOTHING RETURNING id',
+            {'id': flush_id, 'now': now}).scalar() is None
+        deltas = [{'id': id, 'delta': delta}
+                  for id, delta in sorted(deltas.items()) if delta]
+        if not duplicate:
+            if deltas:
+                DB.session.execute(
+                    'UPDATE forms SET counter = coalesce(counter, 0) + :delta '
+                    'WHERE id = :id', deltas)
+            FormField.add_counts(fields)
+            DB.session.execute(
+                'DELETE FROM counter_flushes WHERE flushed_at < :before',
+                {'before': now - datetime.timedelta(days=7)})
+        DB.session.commit()
+        counters.flushed()
+    except:
+        DB.session.rollback()
+        raise
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            g.log.warning('Form counters flush outlived its lock.')
+
+    if duplicate:
+        g.log.warning('Form counters were already flushed.', flush=flush_id)
+    elif deltas:
+        g.log.info('Flushed form counters.', forms=len(deltas))
+
+
+@celery.task()
+def ingest_submissions():
+    '''
+    Writes the submissions appended to the stream by Form.send (see
+    settings.SUBMISSIONS_STREAM) to Postgres, with a single COPY and commit
+    per batch. Batches are acknowledged only after being committed, with
+    the last entry written recorded in ingest_progress in the same
+    transaction, so one read again after a worker died in between is
+    skipped.
+    '''
+    from formspree.forms import ingest
+    from formspree.forms.models import Form, FormField, Submission
+
+    lock = ingest.lock(settings.SUBMISSIONS_STREAM_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        for _ in range(settings.SUBMISSIONS_STREAM_MAX_BATCHES):
+            batch = ingest.read(settings.SUBMISSIONS_STREAM_BATCH)
+            if not batch:
+                break
+
+            # the last entry committed, locked so that a worker that took
+            # over an expired lock waits for this batch. a batch committed
+            # but not acknowledged (the worker died in between) is read
+            # again, and skipped.
+            DB.session.execute(
+                "INSERT INTO ingest_progress (stream, last_entry_id) "
+                "VALUES (:stream, '0-0') ON CONFLICT (stream) DO NOTHING",
+                {'stream': ingest.REDIS_SUBMISSIONS_STREAM_KEY})
+            last = DB.session.execute(
+                'SELECT last_entry_id FROM ingest_progress '
+                'WHERE stream = :stream FOR UPDATE',
+                {'stream': ingest.REDIS_SUBMISSIONS_STREAM_KEY}).scalar()
+            entries = [entry for entry in batch
+                       if ingest.entry_key(entry[0]) > ingest.entry_key(last)]
+
+            # forms deleted in the meantime would fail the whole batch.
+            form_ids = {form_id for _, form_id, _, _, _ in entries}
+            existing = {id for id, in DB.session.query(Form.id)
+                        .filter(Form.id.in_(form_ids))}
+
+            rows = io.StringIO()
+            writer = csv.writer(rows)
+            fields = collections.Counter()
+            for _, form_id, submitted_at, data, large in entries:
+                if form_id not in existing:
+                    continue
+                # the compressed fields are searchable too, so submissions
+                # that have them carry their whole data for the search
+                # vector. empty columns are NULL.
+                full = merge_large_fields(data, large)
+                writer.writerow([form_id, submitted_at.isoformat(),
+                                 json.dumps(data),
+                                 '\\x' + large.hex() if large else '',
+                                 json.dumps(full) if large else ''])
+                fields.update((form_id, name) for name in full)
+            rows.seek(0)
+
+            # the raw connection is the session's, so this is all one
+            # transaction. the search vectors are computed on the way from
+            # the staging table.
+            DB.session.execute('CREATE TEMP TABLE submissions_staging '
+                               '(form_id INTEGER, submitted_at TIMESTAMP, data JSONB, '
+                               'large BYTEA, search_data JSONB) '
+                               'ON COMMIT DROP')
+            cursor = DB.session.connection().connection.cursor()
+            cursor.copy_expert('COPY submissions_staging '
+                               '(form_id, submitted_at, data, large, search_data) '
+                               'FROM STDIN WITH (FORMAT csv)', rows)
+            DB.session.execute(
+                'INSERT INTO submissions (form_id, submitted_at, data, large, search) '
+                'SELECT form_id, submitted_at, data, large, %s FROM submissions_staging'
+                % Submission.SEARCH_VECTOR.format(data='coalesce(search_data, data)'))
+            FormField.record(fields)
+            FormField.add_counts(fields)
+            DB.session.execute(
+                'UPDATE ingest_progress SET last_entry_id = :last '
+                'WHERE stream = :stream',
+                {'stream': ingest.REDIS_SUBMISSIONS_STREAM_KEY,
+                 'last': max((entry_id for entry_id, _, _, _, _ in batch),
+                             key=ingest.entry_key).decode('utf-8')})
+            DB.session.commit()
+
+            ingest.ack([entry_id for entry_id, _, _, _, _ in batch])
+            if existing:
+                redis_store.sadd(REDIS_RETENTION_PENDING_KEY, *existing)
+            g.log.info('Ingested submissions.', count=len(entries))
+    except:
+        DB.session.rollback()
+        raise
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            g.log.warning('Submissions ingestion outlived its lock.')
+
+
+@celery.task()
+def maintain_submission_partitions():
+    '''
+    Creates the submissions partitions for the coming months and drops
+    those past settings.SUBMISSIONS_RETENTION_MONTHS.
+    '''
+    from formspree.forms import partitions
+
+    connection = DB.session.connection()
+    if not partitions.is_partitioned(connection):
+        g.log.warning('The submissions table is not partitioned.')
+        return
+
+    now = datetime.datetime.utcnow()
+    existing = partitions.existing_partitions(connection)
+    if not existing or existing[-1] < partitions.month_start(now, 1):
+        g.log.error('Submission partitions ran low, did this task stop running?',
+                    last=existing[-1].isoformat() if existing else None)
+
+    # including the months of submissions that went to the default
+    # partition, if it ran out of partitions.
+    oldest, _ = partitions.default_partition_dates(connection)
+    moved = partitions.create_partitions(
+        connection, min(oldest or now, now),
+        partitions.month_start(now, settings.SUBMISSIONS_PARTITIONS_AHEAD))
+    if moved:
+        g.log.error('Moved submissions out of the default partition.',
+                    count=moved)
+
+    dropped = 0
+    start = partitions.retention_start(now)
+    if start:
+        dropped = partitions.drop_partitions_before(connection, start)
+    DB.session.commit()
+
+    g.log.info('Maintained submission partitions.', dropped=dropped)
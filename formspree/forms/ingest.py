@@ -0,0 +1,90 @@
+import json
+import datetime
+
+from redis.exceptions import ResponseError
+
+from formspree.stuff import redis_store
+
+from .helpers import split_large_fields
+
+# submissions waiting to be written to Postgres by ingest_submissions,
+# when settings.SUBMISSIONS_STREAM is on. needs Redis >= 5.
+REDIS_SUBMISSIONS_STREAM_KEY = 'submissions_stream'
+REDIS_SUBMISSIONS_GROUP = 'ingest'
+REDIS_SUBMISSIONS_CONSUMER = 'ingest'
+# held by the worker draining the stream, so there's a single consumer.
+REDIS_INGEST_LOCK_KEY = 'submissions_stream_lock'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def append(form_id, data, submitted_at=None):
+    submitted_at = submitted_at or datetime.datetime.utcnow()
+    # large values travel compressed, as they're stored.
+    data, large = split_large_fields(data)
+    fields = ['form_id', form_id,
+              'submitted_at', submitted_at.strftime(TIMESTAMP_FORMAT),
+              'data', json.dumps(data)]
+    if large:
+        fields += ['large', large]
+    redis_store.execute_command(
+        'XADD', REDIS_SUBMISSIONS_STREAM_KEY, '*', *fields)
+
+
+def lock(timeout):
+    '''redis-py's lock only releases the key while it's still its own.'''
+    return redis_store.lock(REDIS_INGEST_LOCK_KEY, timeout=timeout)
+
+
+def entry_key(entry_id):
+    '''Stream entry ids ('<ms>-<seq>') in a comparable form.'''
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+def read(count):
+    '''
+    The next `count` submissions in the stream, as (entry id, form id,
+    submitted_at, data, large) tuples, with large being the compressed
+    fields (see split_large_fields) or None. Those read but never acknowledged (by a
+    worker that died before committing them) come first.
+    '''
+    try:
+        redis_store.execute_command(
+            'XGROUP', 'CREATE', REDIS_SUBMISSIONS_STREAM_KEY,
+            REDIS_SUBMISSIONS_GROUP, '0', 'MKSTREAM')
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    for start in ('0', '>'):
+        reply = redis_store.execute_command(
+            'XREADGROUP', 'GROUP', REDIS_SUBMISSIONS_GROUP,
+            REDIS_SUBMISSIONS_CONSUMER, 'COUNT', count,
+            'STREAMS', REDIS_SUBMISSIONS_STREAM_KEY, start)
+        entries = reply[0][1] if reply else []
+        if entries:
+            break
+
+    submissions = []
+    for entry_id, fields in entries:
+        fields = dict(zip(fields[::2], fields[1::2]))
+        submissions.append((
+            entry_id,
+            int(fields[b'form_id']),
+            datetime.datetime.strptime(fields[b'submitted_at'].decode('utf-8'),
+                                       TIMESTAMP_FORMAT),
+            json.loads(fields[b'data'].decode('utf-8')),
+            fields.get(b'large')
+        ))
+    return submissions
+
+
+def ack(entry_ids):
+    pipe = redis_store.pipeline()
+    pipe.execute_command('XACK', REDIS_SUBMISSIONS_STREAM_KEY,
+                         REDIS_SUBMISSIONS_GROUP, *entry_ids)
+    pipe.execute_command('XDEL', REDIS_SUBMISSIONS_STREAM_KEY, *entry_ids)
+    pipe.execute()
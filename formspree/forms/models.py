@@ -1,28 +1,49 @@
 import hmac
-import random
+import json
 import hashlib
 import datetime
-import pystache
-
-from flask import url_for, render_template, render_template_string, g
-from sqlalchemy.sql import table
-from sqlalchemy.sql.expression import delete
-from sqlalchemy.dialects.postgresql import JSON
-from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy import func
+
+from flask import url_for, render_template, g
+from sqlalchemy.dialects.postgresql import JSON, JSONB, TSVECTOR
+from sqlalchemy import func, event, inspect, tuple_, text, DDL
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.ext.compiler import compiles
 from werkzeug.datastructures import ImmutableMultiDict, \
                                     ImmutableOrderedMultiDict
-from premailer import transform
 
 from formspree import settings
-from formspree.stuff import DB, redis_store, TEMPLATES
-from formspree.utils import send_email, unix_time_for_12_months_from_now, \
-                            next_url, IS_VALID_EMAIL, request_wants_json
+from formspree.stuff import DB, redis_store
+from formspree.utils import send_email, next_url, IS_VALID_EMAIL, \
+                            request_wants_json
 from formspree.users.models import Plan
-from .helpers import HASH, HASHIDS_CODEC, REDIS_COUNTER_KEY, \
+from formspree.template import render_whitelabel_sandboxed, \
+                               TemplateRenderError
+from .helpers import HASH, HASHIDS_CODEC, REDIS_RETENTION_PENDING_KEY, \
                     http_form_to_dict, referrer_to_path, \
                     store_first_submission, fetch_first_submission, \
-                    KEYS_NOT_STORED
+                    deliver_outbox_email, enqueue_outbox_emails, \
+                    stored_data, KEYS_NOT_STORED, \
+                    split_large_fields, merge_large_fields
+from . import archive, counters as form_counters, ingest
+from .partitions import create_partitions, create_default_partition, \
+                        month_start, retention_start
+from .quota import consume as consume_quota, monthly_count, \
+                   QUOTA_WARNING, QUOTA_OVERLIMIT, QUOTA_REJECT
+from .cache import form_controllers, form_id_for_hash, remember_form_hash, \
+                   get_form_snapshot, store_form_snapshot, \
+                   form_surely_missing, remember_missing_form, \
+                   count_missing_form_lookup, invalidate_forms_after_commit, \
+                   new_form_fields, remember_form_fields_after_commit
+
+
+def format_submission(id, submitted_at, data, large=None):
+    '''A stored submission as shown on the dashboard and exports.'''
+    data = merge_large_fields(data, large)
+    data = {k: v for k, v in data.items() if k not in KEYS_NOT_STORED}
+    data['date'] = submitted_at.isoformat()
+    data['id'] = id
+    return data
 
 
 class Form(DB.Model):
@@ -30,14 +51,16 @@ class Form(DB.Model):
 
     id = DB.Column(DB.Integer, primary_key=True)
     hash = DB.Column(DB.String(32), unique=True)
-    email = DB.Column(DB.String(120))
+    email = DB.Column(DB.String(120), index=True)
     host = DB.Column(DB.String(300))
     sitewide = DB.Column(DB.Boolean)
     disabled = DB.Column(DB.Boolean)
     confirm_sent = DB.Column(DB.Boolean)
     confirmed = DB.Column(DB.Boolean)
-    counter = DB.Column(DB.Integer)
-    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'))
+    # submissions are counted on Redis and added here by
+    # flush_form_counters, see the counter property.
+    stored_counter = DB.Column('counter', DB.Integer)
+    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), index=True)
     captcha_disabled = DB.Column(DB.Boolean)
     uses_ajax = DB.Column(DB.Boolean)
     disable_email = DB.Column(DB.Boolean)
@@ -47,7 +70,8 @@ class Form(DB.Model):
                                     # this property is basically useless. use .controllers
     template = DB.relationship('EmailTemplate', uselist=False, back_populates='form')
     submissions = DB.relationship('Submission',
-        backref='form', lazy='dynamic', order_by=lambda: Submission.id.desc())
+        backref='form', lazy='dynamic',
+        order_by=lambda: [Submission.submitted_at.desc(), Submission.id.desc()])
 
     '''
     When the form is created by a spontaneous submission, it is added to
@@ -89,7 +113,7 @@ class Form(DB.Model):
         self.host = host
         self.confirm_sent = False
         self.confirmed = False
-        self.counter = 0
+        self.stored_counter = 0
         self.disabled = False
         self.uses_ajax = request_wants_json()
         self.captcha_disabled = False
@@ -111,32 +135,115 @@ class Form(DB.Model):
 
     @property
     def features(self):
-        return set.union(*[cont.features for cont in self.controllers])
+        return set(form_controllers(self)['features'])
 
     def controlled_by(self, user):
-        for cont in self.controllers:
-            if cont.id == user.id:
-                return True
-        return False
+        return user.id in form_controllers(self)['ids']
 
     def has_feature(self, feature):
-        c = [user for user in self.controllers if user.has_feature(feature)]
-        return len(c) > 0
+        return feature in form_controllers(self)['features']
 
     @classmethod
-    def get_with_hashid(cls, hashid):
+    def get_with_hashid(cls, hashid, cached=False):
         try:
             id = HASHIDS_CODEC.decode(hashid)[0]
-            return cls.query.get(id)
         except IndexError:
             return None
 
-    def serialize(self):
+        if cached:
+            return cls.get_cached(id)
+        return cls.query.get(id)
+
+    @classmethod
+    def get_with_hash(cls, hash, cached=False):
+        if cached:
+            id = form_id_for_hash(hash)
+            form = cls.get_cached(id) if id else None
+            if form and form.hash == hash:
+                return form
+
+        form = cls.query.filter_by(hash=hash).first()
+        if form:
+            remember_form_hash(hash, form.id)
+            if cached:
+                form.cache_snapshot()
+        return form
+
+    # the columns that are cached for a form, all but the counter, which
+    # only gets incremented on the submission path.
+    SNAPSHOT_COLUMNS = ('id', 'hash', 'email', 'host', 'sitewide', 'disabled',
+                        'confirm_sent', 'confirmed', 'owner_id',
+                        'captcha_disabled', 'uses_ajax', 'disable_email',
+                        'disable_storage')
+
+    @classmethod
+    def get_cached(cls, id):
+        '''
+        Read-through lookup for the submission path. Confirmed forms are
+        rebuilt from a snapshot cached on Redis, without querying Postgres,
+        and attached to the session as if they were loaded from it.
+        '''
+        key = cls.__mapper__.identity_key_from_primary_key((id,))
+        form = DB.session.identity_map.get(key)
+        if form:
+            return form
+
+        # scanners hit random targets all the time, answer them without
+        # touching Postgres whenever possible.
+        if form_surely_missing(id):
+            count_missing_form_lookup('filter')
+            return None
+
+        snapshot, missing = get_form_snapshot(id)
+        if missing:
+            count_missing_form_lookup('negative_cache')
+            return None
+
+        if not snapshot:
+            form = cls.query.get(id)
+            if form:
+                form.cache_snapshot()
+            else:
+                count_missing_form_lookup('database')
+                remember_missing_form(id)
+            return form
+
+        form = cls.__mapper__.class_manager.new_instance()
+        for column in cls.SNAPSHOT_COLUMNS:
+            setattr(form, column, snapshot[column])
+        make_transient_to_detached(form)  # unset columns will be lazy-loaded
+        DB.session.add(form)
+        return form
+
+    @property
+    def counter(self):
+        '''
+        All the submissions this form ever got, including those that weren't
+        flushed to Postgres yet.
+        '''
+        return (self.stored_counter or 0) + \
+            form_counters.pending(self.id)[self.id]
+
+    def cache_snapshot(self):
+        # only forms that are past the confirmation dance are stable
+        # enough to be worth caching.
+        if self.confirmed and self.host and self.uses_ajax is not None:
+            store_form_snapshot({
+                column: getattr(self, column)
+                for column in self.SNAPSHOT_COLUMNS
+            })
+
+    def serialize(self, pending_counter=None):
+        if pending_counter is None:
+            counter = self.counter
+        else:  # when fetched in bulk for many forms
+            counter = (self.stored_counter or 0) + pending_counter
+
         return {
             'sitewide': self.sitewide,
             'hashid': self.hashid,
             'hash': self.hash,
-            'counter': self.counter,
+            'counter': counter,
             'email': self.email,
             'host': self.host,
             'template': self.template.serialize() if self.template else None,
@@ -156,26 +263,184 @@ class Form(DB.Model):
 
     def submissions_with_fields(self):
         '''
-        Fetch all submissions, extract all fields names from every submission
-        into a single fields list, excluding the KEYS_NOT_STORED values, because
-        they are worthless.
+        Fetch all submissions, excluding the KEYS_NOT_STORED values, because
+        they are worthless, and the names of all their fields (see
+        submission_fields).
         Add the special 'date' field to every submission entry, based on
         .submitted_at, and use this as the first field on the fields array.
         '''
 
-        fields = set()
         submissions = []
-        for s in self.submissions:
-            data = s.data.copy()
-            fields.update(data.keys())
+        for s in self.submissions_query(Submission):
+            data = merge_large_fields(s.data, s.large).copy()
             data["date"] = s.submitted_at.isoformat()
             data["id"] = s.id
             for k in KEYS_NOT_STORED:
                 data.pop(k, None)
             submissions.append(data)
 
-        fields = ['date'] + sorted(fields - KEYS_NOT_STORED)
-        return submissions, fields
+        return submissions, self.submission_fields()
+
+    def submission_fields(self):
+        '''
+        The fields of all submissions, in the same format as
+        submissions_with_fields, in the order they were first seen.
+        Read from the catalog in form_fields (filled for existing forms by
+        its migration), or collected by Postgres for forms without one.
+        '''
+        names = [name for name, in DB.session.query(FormField.name)
+            .filter(FormField.form_id == self.id)
+            .order_by(FormField.id)]
+        if not names:
+            keys = DB.session.query(func.jsonb_object_keys(Submission.data)) \
+                .filter(Submission.form_id == self.id) \
+                .distinct()
+            names = sorted({key for key, in keys})
+        return ['date'] + [name for name in names if name not in KEYS_NOT_STORED]
+
+    def record_fields(self, names):
+        '''
+        Adds the fields of a new submission to the catalog in form_fields,
+        in the current transaction. Postgres is only asked about those not
+        known to be there already (see new_form_fields). Their counts are
+        buffered on Redis and flushed by flush_form_counters, so busy forms
+        don't update the same rows on every submission.
+        '''
+        names = list(names)
+        new = new_form_fields(self.id, names)
+        if new:
+            FormField.record([(self.id, name) for name in new])
+            remember_form_fields_after_commit(DB.session, self.id, new)
+        form_counters.add_fields(self.id, names)
+
+    def submissions_query(self, *columns):
+        '''
+        A query for `columns` of this form's submissions, newest first.
+        Partitions older than the retention period that weren't dropped
+        yet (see maintain_submission_partitions) are pruned from it.
+        '''
+        query = DB.session.query(*columns) \
+            .filter(Submission.form_id == self.id)
+        start = retention_start()
+        if start:
+            query = query.filter(Submission.submitted_at >= start)
+        return query.order_by(Submission.submitted_at.desc(),
+                              Submission.id.desc())
+
+    def iter_submissions(self, chunk_size=1000, archived=False):
+        '''
+        Yields all submissions, newest first, formatted like in
+        submissions_with_fields, reading them from a server-side cursor
+        `chunk_size` rows at a time. With `archived`, those in the cold
+        archive follow, a segment at a time.
+        '''
+        rows = self.submissions_query(Submission.id, Submission.submitted_at,
+                                      Submission.data, Submission.large) \
+            .execution_options(stream_results=True) \
+            .yield_per(chunk_size)
+
+        for row in rows:
+            yield format_submission(*row)
+
+        if not archived or archive.store() is None:
+            return
+
+        # then the older ones, moved out of Postgres by enforce_retention.
+        segments = ArchiveSegment.query \
+            .filter(ArchiveSegment.form_id == self.id) \
+            .order_by(ArchiveSegment.last_submitted_at.desc(),
+                      ArchiveSegment.id.desc())
+        start = retention_start()
+        if start:
+            segments = segments.filter(ArchiveSegment.last_submitted_at >= start)
+        for segment in segments.all():
+            for sub in archive.read(segment.key):
+                yield sub
+
+    def search_submissions(self, q, limit, offset=0):
+        '''
+        The submissions with all the words in `q` (web search syntax, see
+        websearch_to_tsquery), best matches first, formatted like in
+        submissions_with_fields. Returns up to `limit` of them, skipping
+        `offset`, and the offset of the next page (None on the last one).
+        '''
+        query = func.websearch_to_tsquery(Submission.SEARCH_CONFIG, q)
+        rows = self.submissions_query(Submission.id, Submission.submitted_at,
+                                      Submission.data, Submission.large) \
+            .filter(Submission.search.op('@@')(query)) \
+            .order_by(None) \
+            .order_by(func.ts_rank(Submission.search, query).desc(),
+                      Submission.submitted_at.desc(), Submission.id.desc()) \
+            .offset(offset) \
+            .limit(limit + 1) \
+            .all()
+
+        next = offset + limit if len(rows) > limit else None
+        submissions = [format_submission(*row) for row in rows[:limit]]
+        return submissions, next
+
+    def submissions_page(self, limit, before=None, since=None, fields=None,
+                         where=None):
+        '''
+        Like submissions_with_fields, but only for a page of up to `limit`
+        submissions, newest first, with ids lower than `before` and higher
+        than `since`, and with the values in `where` (a dict of fields), if
+        given. When `fields` is given only these keys are fetched from each
+        submission.
+        Returns the submissions, the fields (all of the form's, unless
+        projected) and the `before` cursor of the next page (None on the
+        last one).
+        '''
+        if fields is None:
+            columns = [Submission.data]
+        else:
+            fields = [f for f in fields if f not in KEYS_NOT_STORED]
+            columns = [Submission.data[f] for f in fields]
+        # the compressed fields, decompressed here.
+        columns.append(Submission.large)
+
+        query = self.submissions_query(Submission.id, Submission.submitted_at,
+                                       *columns)
+        # the cursors are ids, but the submission dates bound the
+        # partitions that have to be looked at.
+        key = tuple_(Submission.submitted_at, Submission.id)
+        if before is not None:
+            date = self.submission_date(before)
+            query = query.filter(Submission.submitted_at <= date,
+                                 key < (date, before)) \
+                if date else query.filter(Submission.id < before)
+        if since is not None:
+            date = self.submission_date(since)
+            query = query.filter(Submission.submitted_at >= date,
+                                 key > (date, since)) \
+                if date else query.filter(Submission.id > since)
+        if where:
+            # answered by the GIN index on data.
+            query = query.filter(Submission.data.contains(where))
+        rows = query.limit(limit + 1).all()
+
+        next = rows[limit - 1][0] if len(rows) > limit else None
+
+        submissions = []
+        for id, submitted_at, *values, large in rows[:limit]:
+            if fields is None:
+                data = {k: v for k, v in merge_large_fields(values[0], large).items()
+                        if k not in KEYS_NOT_STORED}
+            else:
+                data = {k: v for k, v in zip(fields, values) if v is not None}
+                data = merge_large_fields(data, large, fields)
+            data['date'] = submitted_at.isoformat()
+            data['id'] = id
+            submissions.append(data)
+
+        if fields is None:
+            return submissions, self.submission_fields(), next
+        return submissions, ['date'] + fields, next
+
+    def submission_date(self, id):
+        return DB.session.query(Submission.submitted_at) \
+            .filter(Submission.form_id == self.id, Submission.id == id) \
+            .scalar()
 
     def send(self, data, keys, referrer):
         '''
@@ -218,70 +483,75 @@ class Form(DB.Model):
                 'referrer': referrer
             }
 
-        # increase the monthly counter
-        request_date = datetime.datetime.now()
-        self.increase_monthly_counter(basedate=request_date)
+        # count the submission against the monthly quota
+        monthly_limit = settings.MONTHLY_SUBMISSIONS_LIMIT \
+                if self.id > settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE \
+                else settings.GRANDFATHER_MONTHLY_LIMIT
+        monthly_counter, quota = consume_quota(
+            self.id,
+            None if self.has_feature('unlimited') else monthly_limit,
+            settings.OVERLIMIT_NOTIFICATION_QUANTITY
+        )
 
         # increment the forms counter
-        self.counter = Form.counter + 1
+        form_counters.add(self.id)
 
         # if submission storage is disabled, don't store submission
         if self.disable_storage and self.has_feature('dashboard'):
             pass
+        elif settings.SUBMISSIONS_STREAM:
+            # written to Postgres in bulk by ingest_submissions.
+            ingest.append(self.id, stored_data(data))
         else:
             DB.session.add(self)
 
             # archive the form contents
             sub = Submission(self.id)
-            sub.data = {key: data[key] for key in data if key not in KEYS_NOT_STORED}
+            stored = stored_data(data)
+            sub.data, sub.large = split_large_fields(stored)
+            sub.search = Submission.search_vector(stored)
             DB.session.add(sub)
+            self.record_fields(stored.keys())
 
-            # commit changes
-            DB.session.commit()
+            # submissions over the archive limit are deleted later,
+            # by enforce_retention.
+            redis_store.sadd(REDIS_RETENTION_PENDING_KEY, self.id)
 
-        # sometimes we'll delete all archived submissions over the limit
-        if random.random() < settings.EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY:
-            records_to_keep = settings.ARCHIVED_SUBMISSIONS_LIMIT
-            total_records = DB.session.query(func.count(Submission.id)) \
-                .filter_by(form_id=self.id) \
-                .scalar()
-
-            if total_records > records_to_keep:
-                newest = self.submissions.with_entities(Submission.id).limit(records_to_keep)
-                DB.engine.execute(
-                  delete(table('submissions')). \
-                  where(Submission.form_id == self.id). \
-                  where(~Submission.id.in_(newest))
-                )
+        # the single commit of this request, with the submission and the
+        # changes made to the form before getting here (see endpoint.send).
+        # when using the outbox it's done later, together with the email
+        # that notifies the submission.
+        if not settings.EMAIL_OUTBOX:
+            DB.session.commit()
 
         # url to request_unconfirm_form page
         unconfirm = url_for('request_unconfirm_form', form_id=self.id, _external=True)
 
         # check if the forms are over the counter and the user has unlimited submissions
-        overlimit = False
-        monthly_counter = self.get_monthly_counter()
-        monthly_limit = settings.MONTHLY_SUBMISSIONS_LIMIT \
-                if self.id > settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE \
-                else settings.GRANDFATHER_MONTHLY_LIMIT
+        overlimit = quota in (QUOTA_OVERLIMIT, QUOTA_REJECT)
 
-        if monthly_counter > monthly_limit and not self.has_feature('unlimited'):
-            overlimit = True
+        # emails committed on the outbox by this request, handed to the
+        # worker after the commit.
+        outbox = []
 
-        if monthly_counter == int(monthly_limit * 0.9) and \
-                        not self.has_feature('unlimited'):
+        if quota == QUOTA_WARNING:
             # send email notification
-            send_email(
+            warning = dict(
                 to=self.email,
                 subject="Formspree Notice: Approaching submission limit.",
                 text=render_template('email/90-percent-warning.txt',
                     unconfirm_url=unconfirm, limit=monthly_limit
                 ),
-                html=render_template_string(
-                    TEMPLATES.get('90-percent-warning.html'),
+                html=render_template('email/inlined/90-percent-warning.html',
                     unconfirm_url=unconfirm, limit=monthly_limit
                 ),
                 sender=settings.DEFAULT_SENDER
             )
+            if settings.EMAIL_OUTBOX:
+                outbox.append(OutboxEmail(self.id, warning))
+                DB.session.add(outbox[-1])
+            else:
+                send_email(**warning)
 
         now = datetime.datetime.utcnow().strftime('%I:%M %p UTC - %d %B %Y')
 
@@ -293,17 +563,23 @@ class Form(DB.Model):
 
             # if there's a custom email template we should use it
             # otherwise check if the user wants a new or old version of the email
+            html = None
             if self.has_feature('whitelabel') and self.template:
-                html, subject = self.template.render_body_and_subject(
-                    data=data, host=self.host, keys=keys, now=now,
-                    unconfirm_url=unconfirm)
-                from_name = self.template.from_name
-            elif format == 'plain':
+                try:
+                    html, subject = self.template.render_body_and_subject(
+                        data=data, host=self.host, keys=keys, now=now,
+                        unconfirm_url=unconfirm)
+                    from_name = self.template.from_name
+                except TemplateRenderError as e:
+                    g.log.warning('Failed to render custom template, '
+                                  'using the default.', error=str(e))
+
+            if html is None and format == 'plain':
                 html = render_template('email/plain_form.html',
                     data=data, host=self.host, keys=keys, now=now,
                     unconfirm_url=unconfirm)
-            else:
-                html = render_template_string(TEMPLATES.get('form.html'),
+            elif html is None:
+                html = render_template('email/inlined/form.html',
                     data=data, host=self.host, keys=keys, now=now,
                     unconfirm_url=unconfirm)
         else:
@@ -312,20 +588,25 @@ class Form(DB.Model):
             # send an overlimit notification for the first x overlimit emails
             # after that, return an error so the user can know the website owner is not
             # going to read his message.
-            if monthly_counter <= monthly_limit + settings.OVERLIMIT_NOTIFICATION_QUANTITY:
+            if quota == QUOTA_OVERLIMIT:
                 subject = 'Formspree Notice: Your submission limit has been reached.'
                 text = render_template('email/overlimit-notification.txt',
                     host=self.host, unconfirm_url=unconfirm, limit=monthly_limit)
-                html = render_template_string(TEMPLATES.get('overlimit-notification.html'),
+                html = render_template('email/inlined/overlimit-notification.html',
                     host=self.host, unconfirm_url=unconfirm, limit=monthly_limit)
             else:
+                if settings.EMAIL_OUTBOX:
+                    DB.session.commit()
                 return {'code': Form.STATUS_OVERLIMIT}
 
         # if emails are disabled, don't send email notification
         if self.disable_email and self.has_feature('dashboard'):
+            if settings.EMAIL_OUTBOX:
+                DB.session.commit()
+                enqueue_outbox_emails(outbox)
             return {'code': Form.STATUS_NO_EMAIL, 'next': next}
         else:
-            result = send_email(
+            message = dict(
                 to=self.email,
                 subject=subject,
                 text=text,
@@ -345,6 +626,18 @@ class Form(DB.Model):
                 }
             )
 
+            if settings.EMAIL_OUTBOX:
+                # the email is committed with the submission and
+                # delivered by the worker, SendGrid is out of our way.
+                outbox.append(OutboxEmail(self.id, message))
+                DB.session.add(outbox[-1])
+                DB.session.commit()
+                enqueue_outbox_emails(outbox)
+                g.log.info('Email queued on the outbox.', outbox=outbox[-1].id)
+                return {'code': Form.STATUS_EMAIL_SENT, 'next': next}
+
+            result = send_email(**message)
+
             if not result[0]:
                 g.log.warning('Failed to send email.',
                               reason=result[1], code=result[2])
@@ -364,18 +657,69 @@ class Form(DB.Model):
             return {'code': Form.STATUS_EMAIL_SENT, 'next': next}
 
     def get_monthly_counter(self, basedate=None):
-        basedate = basedate or datetime.datetime.now()
-        month = basedate.month
-        key = REDIS_COUNTER_KEY(form_id=self.id, month=month)
-        counter = redis_store.get(key) or 0
-        return int(counter)
-
-    def increase_monthly_counter(self, basedate=None):
-        basedate = basedate or datetime.datetime.now()
-        month = basedate.month
-        key = REDIS_COUNTER_KEY(form_id=self.id, month=month)
-        redis_store.incr(key)
-        redis_store.expireat(key, unix_time_for_12_months_from_now(basedate))
+        return monthly_count(self.id, basedate)
+
+    @property
+    def archive_limit(self):
+        '''
+        How many submissions are kept for this form: the most generous
+        limit among the plans of the users that control it.
+        '''
+        from formspree.users.models import User
+        plans = [plan for plan, in self.controllers.with_entities(User.plan)]
+        return max([settings.ARCHIVED_SUBMISSIONS_PLAN_LIMITS.get(
+                        plan, settings.ARCHIVED_SUBMISSIONS_LIMIT)
+                    for plan in plans] or [settings.ARCHIVED_SUBMISSIONS_LIMIT])
+
+    def delete_submissions_over_limit(self, batch_size, max_batches):
+        '''
+        Deletes the oldest submissions beyond archive_limit, in batches of
+        `batch_size` oldest first, committing after each batch. Those of
+        paying forms are moved to the cold archive when there's one (see
+        ArchiveSegment).
+        Returns False when it stopped after `max_batches` with more to delete.
+        '''
+        archiving = archive.store() is not None and self.has_feature('dashboard')
+        columns = [Submission.submitted_at, Submission.id]
+        if archiving:
+            columns.extend([Submission.data, Submission.large])
+
+        # the newest of the submissions that must go.
+        key = tuple_(Submission.submitted_at, Submission.id)
+        cutoff = DB.session.query(Submission.submitted_at, Submission.id) \
+            .filter(Submission.form_id == self.id) \
+            .order_by(Submission.submitted_at.desc(), Submission.id.desc()) \
+            .offset(self.archive_limit) \
+            .limit(1) \
+            .first()
+        if cutoff is None:
+            return True
+
+        after = (datetime.datetime.min, 0)
+        for _ in range(max_batches):
+            rows = DB.session.query(*columns) \
+                .filter(Submission.form_id == self.id) \
+                .filter(Submission.submitted_at <= cutoff[0]) \
+                .filter(key > after, key <= tuple(cutoff)) \
+                .order_by(Submission.submitted_at, Submission.id) \
+                .limit(batch_size) \
+                .all()
+            if not rows:
+                return True
+
+            if archiving:
+                DB.session.add(ArchiveSegment.write(self.id, rows))
+            Submission.query \
+                .filter(Submission.submitted_at.between(rows[0][0], rows[-1][0])) \
+                .filter(Submission.id.in_([row[1] for row in rows])) \
+                .delete(synchronize_session=False)
+            DB.session.commit()
+
+            if len(rows) < batch_size:
+                return True
+            after = tuple(rows[-1][:2])
+
+        return False
 
     def send_confirmation(self, store_data=None):
         '''
@@ -390,6 +734,12 @@ class Form(DB.Model):
             g.log.debug('Previously sent.')
             return {'code': Form.STATUS_CONFIRMATION_DUPLICATED}
 
+        # inserted or updated once, assuming the email goes out.
+        self.confirm_sent = True
+        DB.session.add(self)
+        DB.session.flush()
+        g.log = g.log.bind(form=self.id)
+
         # the nonce for email confirmation will be the hash when it exists
         # (whenever the form was created from a simple submission) or
         # a concatenation of HASH(email, id) + ':' + hashid
@@ -415,13 +765,10 @@ class Form(DB.Model):
                 keys=keys
             )
             if ext == 'html':
-                return render_template_string(TEMPLATES.get('confirm.html'), **params)
+                return render_template('email/inlined/confirm.html', **params)
             elif ext == 'txt':
                 return render_template('email/confirm.txt', **params)
 
-        DB.session.add(self)
-        DB.session.flush()
-
         result = send_email(
             to=self.email,
             subject='Confirm email for {} on {}' \
@@ -442,12 +789,11 @@ class Form(DB.Model):
         g.log.debug('Confirmation email queued.')
 
         if not result[0]:
+            self.confirm_sent = False
+            DB.session.commit()
             return {'code': Form.STATUS_CONFIRMATION_FAILED}
 
-        self.confirm_sent = True
-        DB.session.add(self)
         DB.session.commit()
-
         return {'code': Form.STATUS_CONFIRMATION_SENT}
 
     @classmethod
@@ -471,9 +817,9 @@ class Form(DB.Model):
             DB.session.add(form)
             DB.session.commit()
 
-            stored_data = fetch_first_submission(nonce)
-            if stored_data:
-                form.send(stored_data, stored_data.keys(), form.host)
+            first_submission = fetch_first_submission(nonce)
+            if first_submission:
+                form.send(first_submission, first_submission.keys(), form.host)
 
             return form
 
@@ -510,6 +856,20 @@ class Form(DB.Model):
         return True
 
 
+@event.listens_for(Form, 'after_update')
+def form_changed(mapper, connection, form):
+    state = inspect(form)
+    if any(state.attrs[column].history.has_changes()
+           for column in Form.SNAPSHOT_COLUMNS):
+        invalidate_forms_after_commit(state.session, form.id)
+
+
+@event.listens_for(Form, 'after_insert')
+@event.listens_for(Form, 'after_delete')
+def form_created_or_deleted(mapper, connection, form):
+    invalidate_forms_after_commit(inspect(form).session, form.id)
+
+
 class EmailTemplate(DB.Model):
     __tablename__ = 'email_templates'
 
@@ -571,26 +931,264 @@ class EmailTemplate(DB.Model):
             '_time': now,
             '_host': host
         })
-        subject = pystache.render(self.subject, data)
-        html = pystache.render('<style>' + self.style + '</style>' + self.body, data)
-        print(html)
-        inlined = transform(html)
+        inlined, subject = render_whitelabel_sandboxed(
+            self.subject, self.style, self.body, data)
         suffixed = inlined + '''<table width="100%"><tr><td>You are receiving this because you confirmed this email address on <a href="{service_url}">{service_name}</a>. If you don't remember doing that, or no longer wish to receive these emails, please remove the form on {host} or <a href="{unconfirm_url}">click here to unsubscribe</a> from this endpoint.</td></tr></table>'''.format(service_url=settings.SERVICE_URL, service_name=settings.SERVICE_NAME, host=host, unconfirm_url=unconfirm_url)
         return suffixed, subject
 
 
+class FormField(DB.Model):
+    __tablename__ = 'form_fields'
+    __table_args__ = (DB.UniqueConstraint('form_id', 'name'),)
+
+    id = DB.Column(DB.Integer, primary_key=True)
+    form_id = DB.Column(
+        DB.Integer, DB.ForeignKey('forms.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    name = DB.Column(DB.Text, nullable=False)
+    first_seen_at = DB.Column(DB.DateTime, nullable=False)
+    count = DB.Column(DB.Integer, nullable=False)
+
+    '''
+    The catalog of the fields found in a form's stored submissions, in the
+    order they were first seen (by `id`), with the number of submissions
+    that had each of them. Maintained by Form.send, see Form.record_fields.
+    '''
+
+    # neither writes nor locks the rows that exist.
+    INSERT_NEW = '''
+        INSERT INTO form_fields (form_id, name, first_seen_at, count)
+        VALUES {values}
+        ON CONFLICT (form_id, name) DO NOTHING
+    '''
+
+    @classmethod
+    def record(cls, fields):
+        '''
+        Adds to the catalog, with a count of 0, the fields given as
+        (form_id, name) that aren't in it yet, in the order they were seen.
+        Counts are added by add_counts. Runs in the current transaction.
+        '''
+        fields = list(fields)
+        if not fields:
+            return
+
+        # the rows aren't inserted in a fixed order, so transactions adding
+        # fields to the same forms take turns instead of deadlocking on
+        # each other's new rows.
+        DB.session.execute(
+            'SELECT pg_advisory_xact_lock(id) FROM unnest(:ids) AS id',
+            {'ids': sorted({form_id for form_id, _ in fields})})
+
+        params = {'now': datetime.datetime.utcnow()}
+        values = []
+        for i, (form_id, name) in enumerate(fields):
+            params.update({'form_id_%s' % i: form_id, 'name_%s' % i: name})
+            values.append('(:form_id_{i}, :name_{i}, :now, 0)'.format(i=i))
+        DB.session.execute(cls.INSERT_NEW.format(values=', '.join(values)),
+                           params)
+
+    @classmethod
+    def add_counts(cls, counts):
+        '''
+        Adds counts, as {(form_id, name): count}, to fields already in the
+        catalog. Those of deleted forms
+        are dropped.
+        '''
+        params = [{'form_id': form_id, 'name': name, 'count': count}
+                  for (form_id, name), count in sorted(counts.items()) if count]
+        if params:
+            DB.session.execute(
+                'UPDATE form_fields SET count = count + :count '
+                'WHERE form_id = :form_id AND name = :name', params)
+
+    def __repr__(self):
+        return '<FormField %s, form=%s, count=%s>' % \
+            (self.name, self.form_id, self.count)
+
+
+class IngestProgress(DB.Model):
+    __tablename__ = 'ingest_progress'
+
+    stream = DB.Column(DB.Text, primary_key=True)
+    last_entry_id = DB.Column(DB.Text, nullable=False)
+
+    '''
+    The last entry of a Redis stream written to Postgres by
+    ingest_submissions, updated in the transaction that writes it.
+    '''
+
+    def __repr__(self):
+        return '<IngestProgress %s, last_entry_id=%s>' % \
+            (self.stream, self.last_entry_id)
+
+
+class CounterFlush(DB.Model):
+    __tablename__ = 'counter_flushes'
+
+    id = DB.Column(DB.Text, primary_key=True)
+    flushed_at = DB.Column(DB.DateTime, nullable=False)
+
+    '''
+    The recent runs of flush_form_counters that were committed, by the id
+    of the counts they took from Redis (see forms/counters.py).
+    '''
+
+    def __repr__(self):
+        return '<CounterFlush %s, flushed_at=%s>' % (self.id, self.flushed_at)
+
+
+class ArchiveSegment(DB.Model):
+    __tablename__ = 'archive_segments'
+
+    id = DB.Column(DB.Integer, primary_key=True)
+    form_id = DB.Column(
+        DB.Integer, DB.ForeignKey('forms.id', ondelete='CASCADE'),
+        nullable=False, index=True
+    )
+    key = DB.Column(DB.Text, nullable=False)
+    first_submitted_at = DB.Column(DB.DateTime, nullable=False)
+    last_submitted_at = DB.Column(DB.DateTime, nullable=False)
+    count = DB.Column(DB.Integer, nullable=False)
+    size = DB.Column(DB.Integer, nullable=False)
+    created_at = DB.Column(DB.DateTime, nullable=False)
+
+    '''
+    A batch of a form's old submissions, moved out of the submissions table
+    by Form.delete_submissions_over_limit into a compressed segment in the
+    archive store under `key`, newest first (see forms/archive.py).
+    '''
+
+    @classmethod
+    def write(cls, form_id, rows):
+        '''
+        Stores a segment with these (submitted_at, id, data, large) rows,
+        oldest first, and returns its index entry, to be committed together with
+        the deletion of the rows.
+        '''
+        blob = archive.compress([format_submission(id, submitted_at, data, large)
+                                 for submitted_at, id, data, large in reversed(rows)])
+        key = archive.segment_key(form_id, rows[0][1], rows[-1][1])
+        archive.store().put(key, blob)
+
+        return cls(form_id=form_id, key=key, count=len(rows), size=len(blob),
+                   first_submitted_at=rows[0][0], last_submitted_at=rows[-1][0],
+                   created_at=datetime.datetime.utcnow())
+
+    def __repr__(self):
+        return '<ArchiveSegment %s, form=%s, count=%s>' % \
+            (self.key, self.form_id, self.count)
+
+
+class OutboxEmail(DB.Model):
+    __tablename__ = 'outbox'
+
+    id = DB.Column(DB.Integer, primary_key=True)
+    form_id = DB.Column(
+        DB.Integer, DB.ForeignKey('forms.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    created_at = DB.Column(DB.DateTime, nullable=False)
+    attempted_at = DB.Column(DB.DateTime)
+    sent_at = DB.Column(DB.DateTime)
+    failed_at = DB.Column(DB.DateTime)
+    attempts = DB.Column(DB.Integer, nullable=False)
+    error = DB.Column(DB.Text)
+    message = DB.Column(JSON, nullable=False)
+
+    '''
+    Emails waiting to be delivered by the worker (see deliver_outbox_email).
+    `message` holds the keyword arguments to `send_email`. A row is pending
+    while both `sent_at` and `failed_at` are empty.
+    '''
+
+    def __init__(self, form_id, message):
+        self.form_id = form_id
+        self.message = message
+        self.created_at = datetime.datetime.utcnow()
+        self.attempts = 0
+
+    def __repr__(self):
+        return '<OutboxEmail %s, form=%s, attempts=%s, sent_at=%s>' % \
+            (self.id, self.form_id, self.attempts, self.sent_at)
+
+    @classmethod
+    def stale(cls, before):
+        '''
+        Pending emails that no task has tried to deliver since `before`,
+        either because the task was lost or because it gave up midway.
+        '''
+        return cls.query \
+            .filter(cls.sent_at == None, cls.failed_at == None) \
+            .filter(func.coalesce(cls.attempted_at, cls.created_at) < before)
+
+
 class Submission(DB.Model):
     __tablename__ = 'submissions'
+    # partitioned by month, see forms/partitions.py.
+    __table_args__ = {'info': {'partition_by': 'RANGE (submitted_at)'}}
 
-    id = DB.Column(DB.Integer, primary_key=True)
-    submitted_at = DB.Column(DB.DateTime)
+    # the partition key must be part of the primary key.
+    id = DB.Column(DB.Integer, primary_key=True, autoincrement=True)
+    submitted_at = DB.Column(DB.DateTime, primary_key=True)
     form_id = DB.Column(DB.Integer, DB.ForeignKey('forms.id'), nullable=False)
-    data = DB.Column(MutableDict.as_mutable(JSON))
+    # submissions are never changed after being stored, so changes to
+    # `data` aren't tracked. indexed for containment queries (@>).
+    data = DB.Column(JSONB)
+    # the values over settings.SUBMISSION_COMPRESS_THRESHOLD, taken out of
+    # `data` as zstd compressed json (see split_large_fields).
+    large = DB.Column(DB.LargeBinary)
+    # the words in the values of data, see Form.search_submissions.
+    search = DB.Column(TSVECTOR)
+
+    SEARCH_CONFIG = 'simple'
+    SEARCH_VECTOR = """jsonb_to_tsvector('%s', {data}, '["string", "numeric"]')""" \
+        % SEARCH_CONFIG
 
     def __init__(self, form_id):
         self.submitted_at = datetime.datetime.utcnow()
         self.form_id = form_id
 
+    @classmethod
+    def search_vector(cls, data):
+        '''Computed by Postgres when the submission is inserted.'''
+        return text(cls.SEARCH_VECTOR.format(data='CAST(:data AS jsonb)')) \
+            .bindparams(data=json.dumps(data))
+
     def __repr__(self):
         return '<Submission %s, form=%s, date=%s, keys=%s>' % \
             (self.id or 'with an id to be assigned', self.form_id, self.submitted_at.isoformat(), self.data.keys())
+
+
+# the submissions of a form, newest first (Form.submissions, pagination,
+# exports and retention all walk this). one per partition.
+DB.Index('ix_submissions_form_id_submitted_at', Submission.form_id,
+         Submission.submitted_at.desc(), Submission.id.desc())
+DB.Index('ix_submissions_data', Submission.data,
+         postgresql_using='gin', postgresql_ops={'data': 'jsonb_path_ops'})
+# searches within a form, the form id is part of the GIN index by btree_gin.
+DB.Index('ix_submissions_search', Submission.form_id, Submission.search,
+         postgresql_using='gin')
+
+
+@compiles(CreateTable, 'postgresql')
+def create_partitioned_table(create, compiler, **kw):
+    sql = compiler.visit_create_table(create)
+    partition_by = create.element.info.get('partition_by')
+    if partition_by:
+        sql = sql.rstrip() + ' PARTITION BY %s\n\n' % partition_by
+    return sql
+
+
+event.listen(Submission.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS btree_gin'))
+
+
+@event.listens_for(Submission.__table__, 'after_create')
+def submissions_created(table, connection, **kw):
+    # new databases get the partitions for the coming months right away.
+    now = datetime.datetime.utcnow()
+    create_default_partition(connection)
+    create_partitions(connection, now,
+                      month_start(now, settings.SUBMISSIONS_PARTITIONS_AHEAD))
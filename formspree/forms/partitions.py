@@ -0,0 +1,150 @@
+import re
+import datetime
+
+from sqlalchemy import text
+
+from formspree import settings
+
+# submissions are range partitioned by the month they were submitted at.
+PARTITION_NAME = 'submissions_{year}_{month:02d}'.format
+PARTITION_NAME_RE = re.compile(r'^submissions_(\d{4})_(\d{2})$')
+# takes the submissions of months without a partition, so they're stored
+# even when maintain_submission_partitions didn't run for a while. moved to
+# their partitions once these are created.
+DEFAULT_PARTITION = 'submissions_default'
+# the table from before partitioning, attached as the partition of all the
+# months before it (see the e5d644ebcf87 migration).
+LEGACY_PARTITION = 'submissions_unpartitioned'
+LEGACY_PARTITION_END_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(date, months=0):
+    '''The first moment of the month of `date`, `months` months later.'''
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+def retention_start(now=None):
+    '''
+    The oldest submissions kept when settings.SUBMISSIONS_RETENTION_MONTHS
+    is set (whole months, counting the current one), or None.
+    '''
+    if not settings.SUBMISSIONS_RETENTION_MONTHS:
+        return None
+    return month_start(now or datetime.datetime.utcnow(),
+                       1 - settings.SUBMISSIONS_RETENTION_MONTHS)
+
+
+def is_partitioned(bind):
+    return bind.execute(text('''
+        SELECT 1 FROM pg_partitioned_table
+        JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+        WHERE pg_class.relname = 'submissions'
+    ''')).scalar() is not None
+
+
+def existing_partitions(bind):
+    '''The months that have a partition, as datetimes, oldest first.'''
+    names = bind.execute(text('''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        WHERE parent.relname = 'submissions'
+    '''))
+    months = []
+    for name, in names:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            months.append(datetime.datetime(int(match.group(1)),
+                                            int(match.group(2)), 1))
+    return sorted(months)
+
+
+def create_default_partition(bind):
+    bind.execute(text('CREATE TABLE IF NOT EXISTS %s PARTITION OF submissions DEFAULT'
+                      % DEFAULT_PARTITION))
+
+
+def default_partition_dates(bind):
+    '''
+    The dates of the oldest and newest submissions in the default
+    partition, (None, None) when it's empty or doesn't exist.
+    '''
+    if bind.execute(text('SELECT to_regclass(:name)'),
+                    name=DEFAULT_PARTITION).scalar() is None:
+        return None, None
+    return tuple(bind.execute(text('SELECT min(submitted_at), max(submitted_at) '
+                                   'FROM %s' % DEFAULT_PARTITION)).first())
+
+
+def create_partitions(bind, start, end):
+    '''
+    Creates the missing partitions for the months from `start` to `end`,
+    moving into them the submissions that went to the default partition
+    meanwhile. Returns how many submissions were moved.
+    '''
+    existing = set(existing_partitions(bind))
+    default_used = default_partition_dates(bind) != (None, None)
+    moved = 0
+    month = month_start(start)
+    while month <= end:
+        if month not in existing:
+            moved += _create_partition(bind, month, default_used)
+        month = month_start(month, 1)
+    return moved
+
+
+def _create_partition(bind, month, default_used):
+    dates = {'start': month, 'end': month_start(month, 1)}
+    create = text('''
+        CREATE TABLE IF NOT EXISTS {name} PARTITION OF submissions
+        FOR VALUES FROM ('{start}') TO ('{end}')
+    '''.format(name=PARTITION_NAME(year=month.year, month=month.month),
+               start=dates['start'].isoformat(), end=dates['end'].isoformat()))
+    in_default = 'FROM %s WHERE submitted_at >= :start AND submitted_at < :end' \
+        % DEFAULT_PARTITION
+
+    if not default_used or not bind.execute(
+            text('SELECT 1 %s LIMIT 1' % in_default), **dates).scalar():
+        bind.execute(create)
+        return 0
+
+    # the partition can't be created while the default one has submissions
+    # of its month, so they're set aside meanwhile. creating it locks the
+    # table anyway, the lock is only taken earlier.
+    bind.execute(text('LOCK TABLE submissions IN ACCESS EXCLUSIVE MODE'))
+    bind.execute(text('CREATE TEMP TABLE submissions_moved AS SELECT * %s'
+                      % in_default), **dates)
+    bind.execute(text('DELETE %s' % in_default), **dates)
+    bind.execute(create)
+    moved = bind.execute(text('INSERT INTO submissions SELECT * FROM submissions_moved')).rowcount
+    bind.execute(text('DROP TABLE submissions_moved'))
+    return moved
+
+
+def drop_partitions_before(bind, cutoff):
+    '''
+    Detaches and drops the partitions that only hold submissions older
+    than `cutoff`. Returns how many were dropped.
+    '''
+    dropped = 0
+    bound = bind.execute(text('SELECT pg_get_expr(relpartbound, oid) FROM pg_class '
+                              'WHERE relname = :name AND relispartition'),
+                         name=LEGACY_PARTITION).scalar()
+    if bound:
+        end = datetime.datetime.strptime(
+            LEGACY_PARTITION_END_RE.search(bound).group(1), '%Y-%m-%d %H:%M:%S')
+        if end <= cutoff:
+            bind.execute(text('ALTER TABLE submissions DETACH PARTITION %s'
+                              % LEGACY_PARTITION))
+            bind.execute(text('DROP TABLE %s' % LEGACY_PARTITION))
+            dropped += 1
+
+    for month in existing_partitions(bind):
+        if month_start(month, 1) > cutoff:
+            break
+        name = PARTITION_NAME(year=month.year, month=month.month)
+        bind.execute(text('ALTER TABLE submissions DETACH PARTITION %s' % name))
+        bind.execute(text('DROP TABLE %s' % name))
+        dropped += 1
+    return dropped
@@ -0,0 +1,103 @@
+import calendar
+import datetime
+
+from formspree.stuff import redis_store
+from formspree.utils import unix_time_for_12_months_from_now
+
+REDIS_QUOTA_KEY = 'monthly_{form_id}_{year}_{month}'.format
+# counters used to ignore the year. they are read once to seed the new ones.
+LEGACY_QUOTA_KEY = 'monthly_{form_id}_{month}'.format
+# set for the rest of the month once a form's submissions get rejected.
+REDIS_OVERLIMIT_KEY = 'overlimit_{form_id}_{year}_{month}'.format
+
+QUOTA_OK = 'ok'
+QUOTA_WARNING = 'warning'       # just reached 90% of the limit
+QUOTA_OVERLIMIT = 'overlimit'   # over the limit, the owner gets notified
+QUOTA_REJECT = 'reject'         # over the limit and already notified enough
+
+# KEYS: counter, legacy counter, overlimit flag
+# ARGV: expireat, limit (-1 for unlimited), overlimit notifications,
+#       start of next month
+CONSUME_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local legacy = redis.call('GET', KEYS[2])
+    if legacy then
+        redis.call('SET', KEYS[1], legacy)
+    end
+end
+
+local counter = redis.call('INCR', KEYS[1])
+redis.call('EXPIREAT', KEYS[1], ARGV[1])
+
+local limit = tonumber(ARGV[2])
+local status = 'ok'
+if limit < 0 then
+    status = 'ok'
+elseif counter > limit + tonumber(ARGV[3]) then
+    status = 'reject'
+    redis.call('SET', KEYS[3], 1)
+    redis.call('EXPIREAT', KEYS[3], ARGV[4])
+elseif counter > limit then
+    status = 'overlimit'
+elseif counter == math.floor(limit * 0.9) then
+    status = 'warning'
+end
+return {counter, status}
+'''
+
+_scripts = {}
+
+
+def _keys(form_id, date):
+    return [REDIS_QUOTA_KEY(form_id=form_id, year=date.year, month=date.month),
+            LEGACY_QUOTA_KEY(form_id=form_id, month=date.month)]
+
+
+def _overlimit_key(form_id, date=None):
+    date = date or datetime.datetime.now()
+    return REDIS_OVERLIMIT_KEY(form_id=form_id, year=date.year, month=date.month)
+
+
+def _start_of_next_month(date):
+    month = date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return calendar.timegm((month + datetime.timedelta(days=32))
+                           .replace(day=1).utctimetuple())
+
+
+def consume(form_id, limit, notifications, date=None):
+    '''
+    Counts a submission against the monthly quota of a form and classifies
+    it, in a single atomic call to Redis. `limit` is None for forms with
+    unlimited submissions. Returns the new monthly counter and one of the
+    QUOTA_ statuses.
+    '''
+    date = date or datetime.datetime.now()
+    if 'consume' not in _scripts:
+        _scripts['consume'] = redis_store.register_script(CONSUME_SCRIPT)
+
+    counter, status = _scripts['consume'](
+        keys=_keys(form_id, date) + [_overlimit_key(form_id, date)],
+        args=[unix_time_for_12_months_from_now(date),
+              -1 if limit is None else limit,
+              notifications,
+              _start_of_next_month(date)]
+    )
+    return int(counter), status.decode('utf-8')
+
+
+def monthly_count(form_id, date=None):
+    date = date or datetime.datetime.now()
+    current, legacy = redis_store.mget(_keys(form_id, date))
+    return int(current or legacy or 0)
+
+
+def is_hard_overlimit(form_id):
+    '''
+    Whether submissions to this form are being rejected for the rest of the
+    month, so new ones can be turned away before doing any work.
+    '''
+    return redis_store.exists(_overlimit_key(form_id))
+
+
+def clear_hard_overlimit(*form_ids):
+    redis_store.delete(*[_overlimit_key(id) for id in form_ids])
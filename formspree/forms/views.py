@@ -2,19 +2,19 @@ import json
 import datetime
 import io
 
-import requests
 import unicodecsv as csv
 from lxml.html import rewrite_links
 
 from flask import request, url_for, render_template, \
                   jsonify, make_response, Response, g, \
-                  session, abort, render_template_string
+                  session, abort, stream_with_context
 from flask_login import current_user, login_required
 
 from formspree import settings
-from formspree.stuff import DB, TEMPLATES
+from formspree.stuff import DB
 from formspree.utils import request_wants_json, jsonerror, \
-                            valid_url, send_email
+                            valid_url, send_email, http_session
+from formspree.template import TemplateRenderError
 from formspree.forms.helpers import verify_captcha, HASH
 from formspree.forms.models import Form, EmailTemplate
 
@@ -32,7 +32,7 @@ def resend_confirmation(email):
 
     if verify_captcha(request.form, request):
         # check if this email is listed on SendGrid's bounces
-        r = requests.get('https://api.sendgrid.com/api/bounces.get.json',
+        r = http_session().get('https://api.sendgrid.com/api/bounces.get.json',
             params={
                 'email': email,
                 'api_user': settings.SENDGRID_USERNAME,
@@ -90,7 +90,7 @@ def unblock_email(email):
 
         if verify_captcha(request.form, request):
             # clear the bounce from SendGrid
-            r = requests.post(
+            r = http_session().post(
                 'https://api.sendgrid.com/api/bounces.delete.json',
                 data={
                     'email': email,
@@ -141,7 +141,7 @@ def request_unconfirm_form(form_id):
     send_email(
         to=form.email,
         subject='Unsubscribe from form at {}'.format(form.host),
-        html=render_template_string(TEMPLATES.get('unsubscribe-confirmation.html'),
+        html=render_template('email/inlined/unsubscribe-confirmation.html',
                                     url=unconfirm_url,
                                     email=form.email,
                                     host=form.host),
@@ -234,12 +234,16 @@ def serve_dashboard(hashid=None, s=None):
 
 @login_required
 def custom_template_preview_render():
-    body, _ = EmailTemplate.make_sample(
-        from_name=request.args.get('from_name'),
-        subject=request.args.get('subject'),
-        style=request.args.get('style'),
-        body=request.args.get('body'),
-    )
+    try:
+        body, _ = EmailTemplate.make_sample(
+            from_name=request.args.get('from_name'),
+            subject=request.args.get('subject'),
+            style=request.args.get('style'),
+            body=request.args.get('body'),
+        )
+    except TemplateRenderError as e:
+        g.log.info('Failed to render template preview.', error=str(e))
+        return 'Failed to render. The template has errors.', 406
 
     return rewrite_links(body, lambda x: "#" + x)
 
@@ -253,35 +257,56 @@ def export_submissions(hashid, format=None):
     if not form.controlled_by(current_user):
         return abort(401)
 
-    submissions, fields = form.submissions_with_fields()
+    # submissions are streamed as they are read from the database, so
+    # exports of any size start right away and use constant memory.
+    # those moved to the cold archive come last.
+    fields = form.submission_fields()
+
+    def submissions():
+        return form.iter_submissions(settings.EXPORT_CHUNK_SIZE, archived=True)
+
+    filename = 'form-%s-submissions-%s' % \
+        (hashid, datetime.datetime.now().isoformat().split('.')[0])
 
     if format == 'json':
-        return Response(
-            json.dumps({
-                'host': form.host,
-                'email': form.email,
-                'fields': fields,
-                'submissions': submissions
-            }, sort_keys=True, indent=2),
-            mimetype='application/json',
-            headers={
-                'Content-Disposition': 'attachment; filename=form-%s-submissions-%s.json' \
-                            % (hashid, datetime.datetime.now().isoformat().split('.')[0])
-            }
-        )
+        def generate():
+            yield '{"email": %s, "fields": %s, "host": %s, "submissions": [' % \
+                (json.dumps(form.email), json.dumps(fields), json.dumps(form.host))
+            for i, sub in enumerate(submissions()):
+                yield (',\n' if i else '\n') + json.dumps(sub, sort_keys=True)
+            yield '\n]}\n'
+
+        mimetype = 'application/json'
+    elif format == 'ndjson':
+        def generate():
+            for sub in submissions():
+                yield json.dumps(sub, sort_keys=True) + '\n'
+
+        mimetype = 'application/x-ndjson'
     elif format == 'csv':
-        out = io.BytesIO()
-        
-        w = csv.DictWriter(out, fieldnames=['id'] + fields, encoding='utf-8')
-        w.writeheader()
-        for sub in submissions:
-            w.writerow(sub)
-
-        return Response(
-            out.getvalue(),
-            mimetype='text/csv',
-            headers={
-                'Content-Disposition': 'attachment; filename=form-%s-submissions-%s.csv' \
-                            % (hashid, datetime.datetime.now().isoformat().split('.')[0])
-            }
-        )
+        def generate():
+            out = io.BytesIO()
+            # a field missing from the catalog must not break the export
+            # after it has started.
+            w = csv.DictWriter(out, fieldnames=['id'] + fields,
+                               extrasaction='ignore', encoding='utf-8')
+            w.writeheader()
+            for i, sub in enumerate(submissions()):
+                w.writerow(sub)
+                if i % settings.EXPORT_CHUNK_SIZE == 0:
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+            yield out.getvalue()
+
+        mimetype = 'text/csv'
+    else:
+        return abort(404)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': 'attachment; filename=%s.%s' % (filename, format)
+        }
+    )
@@ -11,24 +11,59 @@ export default class FormSubmissions extends React.Component {
 
     this.deleteSubmission = this.deleteSubmission.bind(this)
     this.showExportButtons = this.showExportButtons.bind(this)
+    this.fetchSubmissions = this.fetchSubmissions.bind(this)
+    this.changeQuery = this.changeQuery.bind(this)
+    this.search = this.search.bind(this)
+    this.clearSearch = this.clearSearch.bind(this)
 
     this.state = {
-      exporting: false
+      exporting: false,
+      loading: false,
+      submissions: [],
+      fields: ['date'],
+      next: null,
+      query: '',
+      searching: ''
     }
   }
 
+  componentDidMount() {
+    this.fetchSubmissions()
+  }
+
   render() {
     let {form} = this.props
+    let {submissions, fields} = this.state
 
     return (
       <div className="col-1-1 submissions-col">
-        {form.submissions.length ? (
+        <form className="row" onSubmit={this.search}>
+          <div className="col-3-4">
+            <input
+              type="search"
+              placeholder="Search submissions"
+              value={this.state.query}
+              onChange={this.changeQuery}
+            />
+          </div>
+          <div className="col-1-4 right">
+            <button type="submit" disabled={this.state.loading}>
+              Search
+            </button>
+            {this.state.searching && (
+              <button className="no-border" onClick={this.clearSearch}>
+                Clear
+              </button>
+            )}
+          </div>
+        </form>
+        {submissions.length ? (
           <>
             <table className="submissions responsive">
               <thead>
                 <tr>
                   <th>Submitted at</th>
-                  {form.fields
+                  {fields
                     .slice(1 /* the first field is 'date' */)
                     .map(f => (
                       <th key={f}>{f}</th>
@@ -37,7 +72,7 @@ export default class FormSubmissions extends React.Component {
                 </tr>
               </thead>
               <tbody>
-                {form.submissions.map(s => (
+                {submissions.map(s => (
                   <tr id={`submission-${s.id}`} key={s.id}>
                     <td id={`p-${s.id}`} data-label="Submitted at">
                       {new Date(Date.parse(s.date))
@@ -46,7 +81,7 @@ export default class FormSubmissions extends React.Component {
                         .slice(0, 5)
                         .join(' ')}
                     </td>
-                    {form.fields
+                    {fields
                       .slice(1 /* the first field is 'date' */)
                       .map(f => {
                         var value
@@ -75,6 +110,22 @@ export default class FormSubmissions extends React.Component {
                 ))}
               </tbody>
             </table>
+            {this.state.next && (
+              <div className="container">
+                <div className="row">
+                  <div className="col-1-1 center">
+                    <button
+                      onClick={this.fetchSubmissions}
+                      disabled={this.state.loading}
+                    >
+                      {this.state.searching
+                        ? 'Load more results'
+                        : 'Load older submissions'}
+                    </button>
+                  </div>
+                </div>
+              </div>
+            )}
             <div className="container">
               <div className="row">
                 {this.state.exporting ? (
@@ -108,6 +159,8 @@ export default class FormSubmissions extends React.Component {
               </div>
             </div>
           </>
+        ) : this.state.loading ? null : this.state.searching ? (
+          <h3>No submissions match your search.</h3>
         ) : (
           <h3>No submissions archived yet.</h3>
         )}
@@ -115,6 +168,78 @@ export default class FormSubmissions extends React.Component {
     )
   }
 
+  changeQuery(e) {
+    this.setState({query: e.target.value})
+  }
+
+  search(e) {
+    e.preventDefault()
+    this.setState(
+      state => ({searching: state.query.trim(), submissions: [], next: null}),
+      this.fetchSubmissions
+    )
+  }
+
+  clearSearch(e) {
+    e.preventDefault()
+    this.setState(
+      {query: '', searching: '', submissions: [], next: null},
+      this.fetchSubmissions
+    )
+  }
+
+  async fetchSubmissions(e) {
+    if (e) e.preventDefault()
+
+    let {next, searching} = this.state
+    let path = 'submissions'
+    let params = next ? `?before=${next}` : ''
+    if (searching) {
+      // search results are paginated by offset
+      path = 'submissions/search'
+      params = `?q=${encodeURIComponent(searching)}`
+      if (next) params += `&offset=${next}`
+    }
+    this.setState({loading: true})
+
+    try {
+      let resp = await fetch(
+        `/api-int/forms/${this.props.form.hashid}/${path}${params}`,
+        {
+          credentials: 'same-origin',
+          headers: {Accept: 'application/json'}
+        }
+      )
+      let r = await resp.json()
+
+      if (!resp.ok || r.error) {
+        toastr.warning(
+          r.error
+            ? `Error fetching submissions: ${r.error}`
+            : 'Error fetching submissions.'
+        )
+        return
+      }
+
+      this.setState(state => ({
+        submissions: state.submissions.concat(r.submissions),
+        fields: ['date'].concat(
+          Array.from(
+            new Set(state.fields.slice(1).concat(r.fields.slice(1)))
+          ).sort()
+        ),
+        next: r.next
+      }))
+    } catch (e) {
+      console.error(e)
+      toastr.error(
+        'Failed to fetch submissions, see the console for more details.'
+      )
+    } finally {
+      this.setState({loading: false})
+    }
+  }
+
   showExportButtons(e) {
     e.preventDefault()
     this.setState({exporting: true})
@@ -146,6 +271,9 @@ export default class FormSubmissions extends React.Component {
       }
 
       toastr.success('Submission deleted.')
+      this.setState(state => ({
+        submissions: state.submissions.filter(s => s.id !== parseInt(subid))
+      }))
       this.props.onUpdate()
     } catch (e) {
       console.error(e)
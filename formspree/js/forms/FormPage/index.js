@@ -114,7 +114,7 @@ export default class FormPage extends React.Component {
     let hashid = this.props.match.params.hashid
 
     try {
-      let resp = await fetch(`/api-int/forms/${hashid}`, {
+      let resp = await fetch(`/api-int/forms/${hashid}?submissions=false`, {
         credentials: 'same-origin',
         headers: {Accept: 'application/json'}
       })
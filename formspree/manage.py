@@ -1,16 +1,23 @@
 import os
+import re
 import sys
-import datetime
+import json
+import timeit
+import subprocess
 import click
 
+from flask import render_template, render_template_string
 from flask_migrate import Migrate
+from sqlalchemy import func
 
 from formspree import app, settings
-from formspree.stuff import redis_store, DB
-from formspree.forms.helpers import REDIS_COUNTER_KEY
-from formspree.forms.models import Form
-
-from celery.bin.celery import main as celery_main
+from formspree.stuff import redis_store, DB, TEMPLATES
+from formspree.template import INLINED_PREFIX, generate_templates
+from formspree.forms import counters
+from formspree.forms.helpers import REDIS_RETENTION_PENDING_KEY, KEYS_NOT_STORED, \
+                                    flush_form_counters
+from formspree.forms.cache import REDIS_FORMS_FILTER_STATS_KEY
+from formspree.forms.models import Form, Submission
 
 # add flask-migrate commands
 migrate = Migrate(app, DB)
@@ -24,7 +31,7 @@ def run_debug(port=os.getenv('PORT', 5000)):
 @click.option('-i', '--id', default=None, help='form id')
 @click.option('-H', '--host', default=None, help='referer hostname')
 @click.option('-e', '--email', default=None, help='form email')
-def monthly_counters(email=None, host=None, id=None, month=datetime.date.today().month):
+def monthly_counters(email=None, host=None, id=None):
     if id:
         query = [Form.query.get(id)]
     elif email and host:
@@ -38,11 +45,170 @@ def monthly_counters(email=None, host=None, id=None, month=datetime.date.today()
         return 1
 
     for form in query:
-        nsubmissions = redis_store.get(REDIS_COUNTER_KEY(form_id=form.id, month=month)) \
-            or 0
+        nsubmissions = form.get_monthly_counter()
         print('%s submissions for %s' % (nsubmissions, form))
 
 
+@app.cli.command()
+def forms_filter_stats():
+    '''shows how many lookups for missing forms were answered without Postgres'''
+    stats = redis_store.hgetall(REDIS_FORMS_FILTER_STATS_KEY)
+    for how in ['filter', 'negative_cache', 'database']:
+        print('%s: %s' % (how, int(stats.get(how.encode('utf-8'), 0))))
+
+
+@app.cli.command()
+def enqueue_retention():
+    '''queues every form with stored submissions for the retention task'''
+    form_ids = [id for id, in DB.session.query(Submission.form_id).distinct()]
+    for i in range(0, len(form_ids), 1000):
+        redis_store.sadd(REDIS_RETENTION_PENDING_KEY, *form_ids[i:i + 1000])
+    print('%s forms queued for retention.' % len(form_ids))
+
+
+@app.cli.command()
+@click.option('-i', '--id', default=None, type=int, help='only this form id')
+def backfill_form_fields(id=None):
+    '''rebuilds the fields catalog of forms from their stored submissions'''
+    query = DB.session.query(Submission.form_id).distinct()
+    if id:
+        query = query.filter(Submission.form_id == id)
+    form_ids = [form_id for form_id, in query]
+
+    for form_id in form_ids:
+        DB.session.execute('''
+            INSERT INTO form_fields (form_id, name, first_seen_at, count)
+            SELECT :form_id, key, min(submitted_at), count(*)
+            FROM submissions, jsonb_object_keys(data) AS key
+            WHERE form_id = :form_id AND key NOT IN :excluded
+            GROUP BY key
+            ORDER BY min(submissions.id), key
+            ON CONFLICT (form_id, name) DO UPDATE
+            SET count = EXCLUDED.count, first_seen_at = EXCLUDED.first_seen_at
+        ''', {'form_id': form_id, 'excluded': tuple(KEYS_NOT_STORED)})
+        DB.session.commit()
+    print('backfilled the fields of %s forms.' % len(form_ids))
+
+
+@app.cli.command()
+@click.option('-b', '--batch', default=10000, help='submissions per transaction')
+def backfill_search(batch):
+    '''fills the search vectors of submissions stored before search existed'''
+    # until then, those submissions aren't found by searches.
+    low, high = DB.session.query(func.min(Submission.id), func.max(Submission.id)) \
+        .filter(Submission.search.is_(None)).one()
+    filled = 0
+    for start in range(low or 0, (high or -1) + 1, batch):
+        filled += DB.session.execute(
+            'UPDATE submissions SET search = %s '
+            'WHERE id >= :start AND id < :end AND search IS NULL'
+            % Submission.SEARCH_VECTOR.format(data='data'),
+            {'start': start, 'end': start + batch}).rowcount
+        DB.session.commit()
+    print('filled the search vectors of %s submissions.' % filled)
+
+
+@app.cli.command()
+@click.option('-i', '--id', default=None, type=int, help='only this form id')
+@click.option('--exact', is_flag=True,
+              help='also lower counters that are over the stored submissions '
+                   '(wrong for forms that had submissions deleted by retention)')
+def reconcile_counters(id=None, exact=False):
+    '''repairs form counters that drifted from their stored submissions'''
+    flush_form_counters(blocking=True)
+
+    query = DB.session.query(Form.id, Form.stored_counter, Form.disable_storage,
+                             func.count(Submission.id)) \
+        .outerjoin(Submission, Submission.form_id == Form.id) \
+        .group_by(Form.id)
+    if id:
+        query = query.filter(Form.id == id)
+    rows = query.all()
+
+    fixes = []
+    for i in range(0, len(rows), 1000):
+        chunk = rows[i:i + 1000]
+        pending = counters.pending(*[form_id for form_id, _, _, _ in chunk])
+        for form_id, stored, disable_storage, stored_submissions in chunk:
+            total = (stored or 0) + pending[form_id]
+            if total < stored_submissions or \
+                    (exact and not disable_storage and total != stored_submissions):
+                fixes.append({'id': form_id,
+                              'counter': stored_submissions - pending[form_id]})
+                print('form %s: %s -> %s' % (form_id, total, stored_submissions))
+
+    if fixes:
+        DB.session.execute('UPDATE forms SET counter = :counter WHERE id = :id',
+                           fixes)
+    DB.session.commit()
+    print('reconciled the counters of %s forms.' % len(fixes))
+
+
+@app.cli.command()
+@click.option('-n', '--number', default=25, help='slowest modules to show')
+def startup_profile(number):
+    '''shows what makes importing the app (web and worker startup) slow'''
+    # in a fresh interpreter, without the cli commands, like gunicorn and celery.
+    env = dict(os.environ)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    script = ('import json, time; t = time.perf_counter(); import formspree; '
+              'from formspree.create_app import STARTUP_TIMINGS; '
+              'print(json.dumps([time.perf_counter() - t, STARTUP_TIMINGS]))')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                          env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    total, steps = json.loads(proc.stdout.splitlines()[-1])
+
+    # "import time: self [us] | cumulative | imported package"
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match:
+            modules.append((int(match.group(2)), int(match.group(1)),
+                            len(match.group(3)) // 2, match.group(4)))
+
+    print('import formspree: %.0fms' % (total * 1000))
+    print('\ncreate_app steps:')
+    for name, seconds in steps:
+        print('  %7.1fms  %s' % (seconds * 1000, name))
+    print('\nslowest top-level imports (cumulative, self):')
+    for cumulative, own, depth, name in sorted(
+            [m for m in modules if m[2] == 0], reverse=True)[:number]:
+        print('  %7.1fms %7.1fms  %s' % (cumulative / 1000, own / 1000, name))
+
+
+@app.cli.command()
+def build_email_templates():
+    '''inlines the css of all email templates and caches them on disk'''
+    templates = generate_templates(rebuild=True)
+    print('built %s templates into %s' % (len(templates), settings.EMAIL_TEMPLATES_CACHE))
+
+
+@app.cli.command()
+@click.option('-n', '--number', default=1000, help='renders per template')
+@click.option('-t', '--template', default='form.html', help='inlined template')
+def benchmark_email_templates(number, template):
+    '''compares rendering inlined templates from strings and from the cache'''
+    context = dict(
+        data={'name': 'Alice', 'message': 'Hello!'}, keys=['name', 'message'],
+        host='example.com', now='just now', unconfirm_url='#'
+    )
+
+    with app.test_request_context():
+        from_string = timeit.timeit(
+            lambda: render_template_string(TEMPLATES[template], **context),
+            number=number
+        )
+        cached = timeit.timeit(
+            lambda: render_template(INLINED_PREFIX + template, **context),
+            number=number
+        )
+
+    print('render_template_string: %.3fms per render' % (from_string * 1000 / number))
+    print('render_template:        %.3fms per render' % (cached * 1000 / number))
+    print('%.1fx faster' % (from_string / cached))
+
+
 @app.cli.command(context_settings={'ignore_unknown_options': True})
 @click.argument('args', nargs=-1)
 def test(args):
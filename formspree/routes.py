@@ -51,6 +51,8 @@ def configure_routes(app):
     app.add_url_rule('/api-int/forms/<hashid>', view_func=fa.update, methods=['PATCH'])
     app.add_url_rule('/api-int/forms/<hashid>', view_func=fa.delete, methods=['DELETE'])
     app.add_url_rule('/api-int/forms/sitewide-check', view_func=fa.sitewide_check, methods=['POST'])
+    app.add_url_rule('/api-int/forms/<hashid>/submissions', view_func=fa.submissions, methods=['GET'])
+    app.add_url_rule('/api-int/forms/<hashid>/submissions/search', view_func=fa.search, methods=['GET'])
     app.add_url_rule('/api-int/forms/<hashid>/submissions/<submissionid>', view_func=fa.submission_delete, methods=['DELETE'])
     app.add_url_rule('/api-int/forms/<hashid>/whitelabel', view_func=fa.custom_template_set, methods=['PUT'])
 
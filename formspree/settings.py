@@ -8,6 +8,8 @@ DEBUG = os.getenv('DEBUG') in ['True', 'true', '1', 'yes']
 if DEBUG:
     SQLALCHEMY_ECHO = True
 TESTING = os.getenv('TESTING') in ['True', 'true', '1', 'yes']
+# set by bin/post_compile, which only imports the app to build its assets.
+BUILDING = os.getenv('BUILDING') in ['True', 'true', '1', 'yes']
 
 SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI') or os.getenv('DATABASE_URL')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -22,9 +24,45 @@ GRANDFATHER_MONTHLY_LIMIT = 1000
 OVERLIMIT_NOTIFICATION_QUANTITY = 25
 MONTHLY_SUBMISSIONS_LIMIT = int(os.getenv('MONTHLY_SUBMISSIONS_LIMIT') or 100)
 ARCHIVED_SUBMISSIONS_LIMIT = int(os.getenv('ARCHIVED_SUBMISSIONS_LIMIT') or 1000)
+SUBMISSIONS_PAGE_SIZE = int(os.getenv('SUBMISSIONS_PAGE_SIZE') or 100)
+SUBMISSIONS_PAGE_MAX = int(os.getenv('SUBMISSIONS_PAGE_MAX') or 500)
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE') or 1000)
+EMAIL_TEMPLATES_CACHE = os.getenv('EMAIL_TEMPLATES_CACHE') or \
+    os.path.join(os.path.dirname(__file__), 'templates/email/inlined.json')
+EMAIL_TEMPLATE_CACHE_SIZE = int(os.getenv('EMAIL_TEMPLATE_CACHE_SIZE') or 1000)
+TEMPLATE_RENDER_POOL_SIZE = int(os.getenv('TEMPLATE_RENDER_POOL_SIZE') or 2)  # 0 renders inline
+TEMPLATE_RENDER_TIMEOUT = float(os.getenv('TEMPLATE_RENDER_TIMEOUT') or 2.0)  # seconds
+TEMPLATE_RENDER_MEMORY_LIMIT = int(os.getenv('TEMPLATE_RENDER_MEMORY_LIMIT') or 512 * 1024 * 1024)  # bytes
+TEMPLATE_RENDER_MAX_TASKS = int(os.getenv('TEMPLATE_RENDER_MAX_TASKS') or 1000)
 FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE = int(os.getenv('FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE') or 0)
 
-EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY = float(os.getenv('EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY') or 0.2)
+# per-plan overrides of ARCHIVED_SUBMISSIONS_LIMIT, like 'v1_gold:5000,v1_platinum:20000'
+ARCHIVED_SUBMISSIONS_PLAN_LIMITS = {
+    plan: int(limit) for plan, limit in
+    (item.split(':') for item in
+     (os.getenv('ARCHIVED_SUBMISSIONS_PLAN_LIMITS') or '').split(',') if item)
+}
+RETENTION_FORMS_PER_RUN = int(os.getenv('RETENTION_FORMS_PER_RUN') or 500)
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE') or 1000)
+RETENTION_MAX_BATCHES = int(os.getenv('RETENTION_MAX_BATCHES') or 10)
+# where the submissions over the archive limit of paying forms are moved
+# to instead of being deleted, like 's3://bucket/archive' or
+# 'file:///var/lib/formspree/archive'. a directory must be shared by the web
+# and worker processes, they refuse to start otherwise.
+SUBMISSIONS_ARCHIVE_STORE = os.getenv('SUBMISSIONS_ARCHIVE_STORE')
+SUBMISSIONS_ARCHIVE_LEVEL = int(os.getenv('SUBMISSIONS_ARCHIVE_LEVEL') or 10)  # zstd
+# submission values longer than this (in characters) are stored compressed,
+# in Postgres and on Redis. 0 disables compression.
+SUBMISSION_COMPRESS_THRESHOLD = int(os.getenv('SUBMISSION_COMPRESS_THRESHOLD') or 4096)
+SUBMISSION_COMPRESS_LEVEL = int(os.getenv('SUBMISSION_COMPRESS_LEVEL') or 3)  # zstd
+
+CONTROLLERS_CACHE_TTL = int(os.getenv('CONTROLLERS_CACHE_TTL') or 3600)  # seconds
+FORM_CACHE_TTL = int(os.getenv('FORM_CACHE_TTL') or 3600)  # seconds
+FORM_HASH_CACHE_SIZE = int(os.getenv('FORM_HASH_CACHE_SIZE') or 10000)
+MISSING_FORM_TTL = int(os.getenv('MISSING_FORM_TTL') or 60)  # seconds
+FORMS_FILTER_ERROR_RATE = float(os.getenv('FORMS_FILTER_ERROR_RATE') or 0.01)
+FORMS_FILTER_REFRESH = int(os.getenv('FORMS_FILTER_REFRESH') or 300)  # seconds
+FORMS_FILTER_MARGIN = int(os.getenv('FORMS_FILTER_MARGIN') or 100)  # ids
 REDIS_URL = os.getenv('REDISTOGO_URL') or os.getenv('REDISCLOUD_URL') or 'redis://localhost:6379'
 
 CDN_URL = os.getenv('CDN_URL')
@@ -38,6 +76,12 @@ DEFAULT_SENDER = os.getenv('DEFAULT_SENDER') or 'Forms Team <submissions@example
 ACCOUNT_SENDER = os.getenv('ACCOUNT_SENDER') or DEFAULT_SENDER
 API_ROOT = os.getenv('API_ROOT') or '//example.com'
 
+# outbound http (SendGrid, reCAPTCHA, sitewide checks) goes through a
+# pooled keep-alive session per process, see utils.http_session.
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT') or 10)  # seconds
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS') or 10)  # hosts
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE') or 10)  # per host
+
 SENDGRID_USERNAME = os.getenv('SENDGRID_USERNAME')
 SENDGRID_PASSWORD = os.getenv('SENDGRID_PASSWORD')
 
@@ -60,3 +104,50 @@ CONTACT_FORM_HASHID = os.getenv('CONTACT_FORM_HASHID', CONTACT_EMAIL)
 TYPEKIT_KEY = os.getenv('TYPEKIT_KEY', '1234567')
 
 CELERY_BROKER_URL = os.getenv('REDIS_URL')
+CELERYBEAT_SCHEDULE = {
+    'drain-outbox': {
+        'task': 'formspree.forms.helpers.drain_outbox',
+        'schedule': 60.0
+    },
+    'rebuild-forms-filter': {
+        'task': 'formspree.forms.helpers.rebuild_forms_filter',
+        'schedule': 600.0
+    },
+    'enforce-retention': {
+        'task': 'formspree.forms.helpers.enforce_retention',
+        'schedule': 60.0
+    },
+    'ingest-submissions': {
+        'task': 'formspree.forms.helpers.ingest_submissions',
+        'schedule': 5.0
+    },
+    'maintain-submission-partitions': {
+        'task': 'formspree.forms.helpers.maintain_submission_partitions',
+        'schedule': 3600.0
+    },
+    'flush-form-counters': {
+        'task': 'formspree.forms.helpers.flush_form_counters',
+        'schedule': float(os.getenv('FORM_COUNTERS_FLUSH_INTERVAL') or 30)
+    }
+}
+FORM_COUNTERS_FLUSH_LOCK_TIMEOUT = int(os.getenv('FORM_COUNTERS_FLUSH_LOCK_TIMEOUT') or 300)  # seconds
+
+# submissions are stored in monthly partitions, created this many months
+# ahead. when a retention period is set (in months, 0 keeps everything)
+# older partitions are dropped whole.
+SUBMISSIONS_PARTITIONS_AHEAD = int(os.getenv('SUBMISSIONS_PARTITIONS_AHEAD') or 3)
+SUBMISSIONS_RETENTION_MONTHS = int(os.getenv('SUBMISSIONS_RETENTION_MONTHS') or 0)
+
+# when enabled, submissions are appended to a Redis stream (Redis >= 5)
+# and written to Postgres in batches by the celery worker.
+SUBMISSIONS_STREAM = os.getenv('SUBMISSIONS_STREAM') in ['True', 'true', '1', 'yes']
+SUBMISSIONS_STREAM_BATCH = int(os.getenv('SUBMISSIONS_STREAM_BATCH') or 1000)
+SUBMISSIONS_STREAM_MAX_BATCHES = int(os.getenv('SUBMISSIONS_STREAM_MAX_BATCHES') or 20)
+SUBMISSIONS_STREAM_LOCK_TIMEOUT = int(os.getenv('SUBMISSIONS_STREAM_LOCK_TIMEOUT') or 300)  # seconds
+
+# when enabled, submission notifications are committed to the outbox table
+# together with the submission and delivered by the celery worker.
+EMAIL_OUTBOX = os.getenv('EMAIL_OUTBOX') in ['True', 'true', '1', 'yes']
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES') or 6)
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY') or 30)  # seconds
+OUTBOX_STALE_AFTER = int(os.getenv('OUTBOX_STALE_AFTER') or 1800)  # seconds
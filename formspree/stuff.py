@@ -1,4 +1,3 @@
-import stripe
 from flask_sqlalchemy import SQLAlchemy
 from flask_cdn import CDN
 from flask_redis import Redis
@@ -9,7 +8,7 @@ from . import settings
 
 DB = SQLAlchemy()
 redis_store = Redis()
-stripe.api_key = settings.STRIPE_SECRET_KEY
 cdn = CDN()
 celery = Celery(__name__, broker=settings.CELERY_BROKER_URL)
-TEMPLATES = generate_templates()
+# the build makes them itself, see build-email-templates.
+TEMPLATES = {} if settings.BUILDING else generate_templates()
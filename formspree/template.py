@@ -1,21 +1,193 @@
 import os
-from premailer import Premailer
+import re
+import html
+import json
+import hashlib
+import resource
+import pystache
+import multiprocessing
+from functools import lru_cache
+from urllib.parse import unquote
+from jinja2 import ChoiceLoader, DictLoader
 
-TEMPLATES_DIR = 'formspree/templates/email/pre_inline_style/'
+from . import settings
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__),
+                             'templates/email/pre_inline_style/')
+
+# the inlined templates can be rendered with render_template under this prefix
+INLINED_PREFIX = 'email/inlined/'
+
+
+def inline_template(source):
+    # premailer is slow to import, and only needed to rebuild the cache.
+    from premailer import Premailer
+
+    p = Premailer(source, remove_classes=True)
+    transformed_template = p.transform()
+
+    # weird issue with jinja templates beforehand so we use this hack
+    # see https://github.com/peterbe/premailer/issues/72
+    mapping = (('%7B%7B', '{{'), ('%7D%7D', '}}'), ('%20', ' '))
+    for k, v in mapping:
+        transformed_template = transformed_template.replace(k, v)
+    return transformed_template
+
+
+def generate_templates(rebuild=False):
+    '''
+    The templates in TEMPLATES_DIR with their css inlined, by filename.
+    Inlining is slow, so the results are kept in the EMAIL_TEMPLATES_CACHE
+    file, keyed by a hash of each source, and only redone for templates
+    that changed since (or for all of them with `rebuild`).
+    '''
+    cache = {}
+    if not rebuild:
+        try:
+            with open(settings.EMAIL_TEMPLATES_CACHE, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
 
-def generate_templates():
     template_map = dict()
-    for filename in os.listdir(TEMPLATES_DIR):
+    changed = False
+    for filename in sorted(os.listdir(TEMPLATES_DIR)):
         if filename.endswith('.html'):
             with open(os.path.join(TEMPLATES_DIR, filename), 'r') as html:
-                p = Premailer(html.read(), remove_classes=True)
-                transformed_template = p.transform()
+                source = html.read()
 
-                # weird issue with jinja templates beforehand so we use this hack
-                # see https://github.com/peterbe/premailer/issues/72
-                mapping = (('%7B%7B', '{{'), ('%7D%7D', '}}'), ('%20', ' '))
-                for k, v in mapping:
-                    transformed_template = transformed_template.replace(k, v)
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+            cached = cache.get(filename)
+            if cached and cached['hash'] == digest:
+                template_map[filename] = cached['html']
+            else:
+                template_map[filename] = inline_template(source)
+                cache[filename] = {'hash': digest, 'html': template_map[filename]}
+                changed = True
+
+    if changed:
+        try:
+            tmp = settings.EMAIL_TEMPLATES_CACHE + '.%s' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, settings.EMAIL_TEMPLATES_CACHE)
+        except OSError:
+            pass  # read-only filesystem, build it at release time.
 
-                template_map[filename] = transformed_template
     return template_map
+
+def configure_inlined_templates(app, templates):
+    '''
+    Makes the inlined templates available to the app's jinja environment,
+    which compiles each of them once and keeps them cached.
+    '''
+    app.jinja_loader = ChoiceLoader([
+        app.jinja_loader,
+        DictLoader({INLINED_PREFIX + name: source
+                    for name, source in templates.items()})
+    ])
+
+
+# css that depends on the structure of the rendered document (like the rows
+# that come out of a mustache section) can't be inlined in the template.
+STRUCTURAL_SELECTORS = re.compile(r':(nth-|first-|last-|only-|empty)')
+
+# premailer urlencodes mustache tags found in attributes and escapes the
+# ones in text (like the & in {{& name }}).
+ENCODED_MUSTACHE_TAG = re.compile(r'(%7B)+.*?(%7D)+')
+MUSTACHE_TAG = re.compile(r'\{\{.*?\}\}', re.S)
+
+
+@lru_cache(maxsize=settings.EMAIL_TEMPLATE_CACHE_SIZE)
+def compiled_mustache(source):
+    return pystache.parse(source)
+
+
+@lru_cache(maxsize=settings.EMAIL_TEMPLATE_CACHE_SIZE)
+def inlined_mustache(style, body):
+    '''
+    The body of a whitelabel template with its style inlined, compiled.
+    Rendering it only fills in the data. Returns None when the style can
+    only be inlined after rendering.
+    '''
+    if STRUCTURAL_SELECTORS.search(style):
+        return None
+
+    from premailer import transform
+    inlined = transform('<style>' + style + '</style>' + body)
+    inlined = ENCODED_MUSTACHE_TAG.sub(lambda m: unquote(m.group(0)), inlined)
+    inlined = MUSTACHE_TAG.sub(lambda m: html.unescape(m.group(0)), inlined)
+    return pystache.parse(inlined)
+
+
+def render_whitelabel(subject, style, body, data):
+    '''
+    Renders the subject and the inlined html of a whitelabel template.
+    Returns (html, subject).
+    '''
+    from premailer import transform
+
+    rendered_subject = pystache.render(compiled_mustache(subject), data)
+    skeleton = inlined_mustache(style, body)
+    if skeleton:
+        inlined = pystache.render(skeleton, data)
+    else:
+        inlined = transform(pystache.render(
+            compiled_mustache('<style>' + style + '</style>' + body),
+            data
+        ))
+    return inlined, rendered_subject
+
+
+class TemplateRenderError(Exception):
+    pass
+
+
+_sandbox = {'pid': None, 'pool': None}
+
+
+def _limit_memory():
+    limit = settings.TEMPLATE_RENDER_MEMORY_LIMIT
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def sandbox_pool():
+    '''
+    The per-process pool of workers that render customer templates, with
+    their memory capped. Created lazily, and again after a fork.
+    '''
+    pid = os.getpid()
+    if _sandbox['pid'] != pid:
+        pool = multiprocessing.Pool(
+            settings.TEMPLATE_RENDER_POOL_SIZE,
+            initializer=_limit_memory,
+            maxtasksperchild=settings.TEMPLATE_RENDER_MAX_TASKS
+        )
+        _sandbox.update(pid=pid, pool=pool)
+    return _sandbox['pool']
+
+
+def render_whitelabel_sandboxed(subject, style, body, data):
+    '''
+    Same as render_whitelabel, but in the sandbox pool, so a pathological
+    template can't pin this process. Raises TemplateRenderError when the
+    template fails, takes longer than TEMPLATE_RENDER_TIMEOUT or runs out
+    of memory.
+    '''
+    if not settings.TEMPLATE_RENDER_POOL_SIZE:
+        try:
+            return render_whitelabel(subject, style, body, data)
+        except Exception as e:
+            raise TemplateRenderError(e) from e
+
+    result = sandbox_pool().apply_async(render_whitelabel,
+                                        (subject, style, body, data))
+    try:
+        return result.get(settings.TEMPLATE_RENDER_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        # the stuck worker can only be stopped with the whole pool.
+        _sandbox['pool'].terminate()
+        _sandbox.update(pid=None, pool=None)
+        raise TemplateRenderError('Timed out rendering the template.')
+    except Exception as e:
+        raise TemplateRenderError(e) from e
@@ -2,11 +2,13 @@ import hmac
 import hashlib
 from datetime import datetime
 
-from flask import url_for, render_template, render_template_string, g
+from flask import url_for, render_template, g
+from sqlalchemy import event, inspect, select, or_
 
 from formspree import settings
-from formspree.stuff import DB, TEMPLATES
+from formspree.stuff import DB
 from formspree.utils import send_email, IS_VALID_EMAIL
+from formspree.forms.cache import invalidate_forms_after_commit
 from .helpers import hash_pwd
 
 
@@ -99,7 +101,7 @@ class User(DB.Model):
             to=self.email,
             subject='Reset your %s password!' % settings.SERVICE_NAME,
             text=render_template('email/reset-password.txt', addr=self.email, link=link),
-            html=render_template_string(TEMPLATES.get('reset-password.html'), add=self.email, link=link),
+            html=render_template('email/inlined/reset-password.html', add=self.email, link=link),
             sender=settings.ACCOUNT_SENDER
         )
         if not res[0]:
@@ -128,7 +130,8 @@ class Email(DB.Model):
     """
 
     address = DB.Column(DB.Text, primary_key=True)
-    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), primary_key=True)
+    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), primary_key=True,
+                         index=True)
     registered_on = DB.Column(DB.DateTime, default=DB.func.now())
 
     @staticmethod
@@ -156,7 +159,7 @@ class Email(DB.Model):
             to=addr,
             subject='Confirm email for your account at %s' % settings.SERVICE_NAME,
             text=render_template('email/confirm-account.txt', email=addr, link=link),
-            html=render_template_string(TEMPLATES.get('confirm-account.html'), email=addr, link=link),
+            html=render_template('email/inlined/confirm-account.html', email=addr, link=link),
             sender=settings.ACCOUNT_SENDER
         )
         if not res[0]:
@@ -180,3 +183,38 @@ class Email(DB.Model):
             return cls(address=addr, owner_id=user_id)
         else:
             return None
+
+
+# the features of a form come from the plans of the users that control it,
+# and are cached (see forms/cache.py). these drop the cache when a plan
+# changes or when a new address makes someone a controller of a form.
+
+@event.listens_for(User, 'after_update')
+def plan_changed(mapper, connection, user):
+    if not inspect(user).attrs.plan.history.has_changes():
+        return
+
+    forms = DB.metadata.tables['forms']
+    emails = Email.__table__
+    controlled = select([forms.c.id]).where(or_(
+        forms.c.owner_id == user.id,
+        forms.c.email.in_(
+            select([emails.c.address]).where(emails.c.owner_id == user.id)
+        )
+    ))
+    invalidate_forms_after_commit(
+        inspect(user).session,
+        *[id for id, in connection.execute(controlled)]
+    )
+
+
+@event.listens_for(Email, 'after_insert')
+@event.listens_for(Email, 'after_delete')
+def email_changed(mapper, connection, email):
+    forms = DB.metadata.tables['forms']
+    invalidate_forms_after_commit(
+        inspect(email).session,
+        *[id for id, in connection.execute(
+            select([forms.c.id]).where(forms.c.email == email.address)
+        )]
+    )
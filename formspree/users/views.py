@@ -1,19 +1,20 @@
 import stripe
 import datetime
 
-from flask import request, flash, url_for, render_template, \
-                  render_template_string, redirect, g
+from flask import request, flash, url_for, render_template, redirect, g
 from flask_login import login_user, logout_user, \
                             current_user, login_required
 from sqlalchemy.exc import IntegrityError
 
 from formspree import settings
-from formspree.stuff import DB, TEMPLATES
+from formspree.stuff import DB
 from formspree.utils import send_email
 from .models import User, Email, Plan
 from .helpers import check_password, hash_pwd, send_downgrade_email, \
                      send_downgrade_reason_email
 
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
 
 def register():
     if request.method == 'GET':
@@ -326,7 +327,7 @@ def stripe_webhook():
                            settings.UPGRADED_PLAN_NAME
                        ),
                        text=render_template('email/payment-failed.txt'),
-                       html=render_template_string(TEMPLATES.get('payment-failed.html')),
+                       html=render_template('email/inlined/payment-failed.html'),
                        sender=settings.DEFAULT_SENDER)
         return 'ok'
     except ValueError as e:
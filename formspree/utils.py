@@ -1,3 +1,7 @@
+import os
+import math
+import struct
+import hashlib
 import requests
 import datetime
 import calendar
@@ -5,12 +9,56 @@ from urllib.parse import urlparse, urlunparse
 import uuid
 import json
 import re
-from flask import request, url_for, jsonify, g
+from requests.adapters import HTTPAdapter
+from flask import request, url_for, jsonify, g, has_request_context
 
 from formspree import settings
 
 IS_VALID_EMAIL = lambda x: re.match(r"[^@]+@[^@]+\.[^@]+", x)
 
+class BloomFilter(object):
+    '''
+    A fixed-size bloom filter over strings. It can tell an item was never
+    added, or that it probably was. Serializes to bytes, so it can be built
+    in one process and shared with the others through Redis.
+    '''
+
+    HEADER = struct.Struct('!QI')
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits or bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, hashes = cls.HEADER.unpack_from(data)
+        return cls(size, hashes, bytearray(data[cls.HEADER.size:]))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.size, self.hashes) + bytes(self.bits)
+
+    def _positions(self, item):
+        digest = hashlib.sha1(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
 def valid_url(url):
     parsed = urlparse(url)
     return len(parsed.scheme) > 0 and len(parsed.netloc) > 0 and not 'javascript:' in url
@@ -117,6 +165,67 @@ def next_url(referrer=None, next=None):
         return url_for('thanks', next=referrer)
 
 
+class PooledSession(requests.Session):
+    '''
+    A requests.Session that applies settings.HTTP_TIMEOUT to every
+    request that doesn't specify its own timeout.
+    '''
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', settings.HTTP_TIMEOUT)
+        return super(PooledSession, self).request(*args, **kwargs)
+
+
+_http = {'pid': None, 'session': None}
+
+
+def http_session():
+    '''
+    The per-process session used for every outbound HTTP call, so TCP and
+    TLS connections are kept alive and reused between calls. A new session
+    is created after a fork, since connections can't be shared between
+    processes.
+    '''
+    pid = os.getpid()
+    if _http['pid'] != pid:
+        session = PooledSession()
+        adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(log_connection_reuse)
+        _http.update(pid=pid, session=session)
+    return _http['session']
+
+
+def http_pool_stats():
+    '''
+    Connection reuse in this process for each pooled host: the number of
+    requests made and the number of connections opened to serve them.
+    '''
+    stats = {}
+    for prefix in ('https://', 'http://'):
+        pools = http_session().get_adapter(prefix).poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats['%s:%s' % (pool.host, pool.port)] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'reused': pool.num_requests - pool.num_connections
+            }
+    return stats
+
+
+def log_connection_reuse(response, *args, **kwargs):
+    if not has_request_context() or not hasattr(g, 'log'):
+        return
+    host = urlparse(response.url).netloc
+    for pool, counts in http_pool_stats().items():
+        if pool.startswith(host):
+            g.log.debug('Outbound request.', pool=pool,
+                        elapsed=response.elapsed.total_seconds(), **counts)
+
+
 def send_email(to=None, subject=None, text=None, html=None,
                sender=None, cc=None, reply_to=None, headers=None,
                from_name=None):
@@ -156,7 +265,7 @@ def send_email(to=None, subject=None, text=None, html=None,
         valid_emails = [email for email in cc if IS_VALID_EMAIL(email)]
         data.update({'cc': valid_emails})
 
-    result = requests.post(
+    result = http_session().post(
         'https://api.sendgrid.com/api/mail.send.json',
         data=data
     )
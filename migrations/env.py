@@ -37,7 +37,7 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, transaction_per_migration=True)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -55,9 +55,13 @@ def run_migrations_online():
                 poolclass=pool.NullPool)
 
     connection = engine.connect()
+    # each migration is committed on its own, so the ones that have to
+    # work outside of a transaction (like building indexes concurrently)
+    # can do it on a separate connection, without waiting on the others.
     context.configure(
                 connection=connection,
-                target_metadata=target_metadata
+                target_metadata=target_metadata,
+                transaction_per_migration=True
                 )
 
     try:
@@ -0,0 +1,25 @@
+"""compressed submission fields
+
+Revision ID: 17fdc31bfb5e
+Revises: e32b38be41d2
+Create Date: 2026-10-18 22:14:36.208417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '17fdc31bfb5e'
+down_revision = 'e32b38be41d2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # added to every partition, without rewriting them. the values are
+    # already compressed, so Postgres shouldn't try again.
+    op.execute('ALTER TABLE submissions ADD COLUMN large BYTEA')
+    op.execute('ALTER TABLE submissions ALTER COLUMN large SET STORAGE EXTERNAL')
+
+
+def downgrade():
+    op.execute('ALTER TABLE submissions DROP COLUMN large')
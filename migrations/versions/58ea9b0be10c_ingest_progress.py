@@ -0,0 +1,26 @@
+"""ingest progress
+
+Revision ID: 58ea9b0be10c
+Revises: 92c27f2c2e69
+Create Date: 2026-10-18 23:24:10.418337
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '58ea9b0be10c'
+down_revision = '92c27f2c2e69'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('ingest_progress',
+    sa.Column('stream', sa.Text(), nullable=False),
+    sa.Column('last_entry_id', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('stream')
+    )
+
+
+def downgrade():
+    op.drop_table('ingest_progress')
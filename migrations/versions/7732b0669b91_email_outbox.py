@@ -0,0 +1,35 @@
+"""email outbox
+
+Revision ID: 7732b0669b91
+Revises: 7446b8bbc888
+Create Date: 2026-10-18 10:12:41.520113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7732b0669b91'
+down_revision = '7446b8bbc888'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('form_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('attempted_at', sa.DateTime(), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.Column('failed_at', sa.DateTime(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('message', postgresql.JSON(), nullable=False),
+    sa.ForeignKeyConstraint(['form_id'], ['forms.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('outbox')
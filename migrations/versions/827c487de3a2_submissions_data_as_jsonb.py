@@ -0,0 +1,32 @@
+"""submissions data as jsonb
+
+Revision ID: 827c487de3a2
+Revises: e5d644ebcf87
+Create Date: 2026-10-18 19:27:40.918305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '827c487de3a2'
+down_revision = 'e5d644ebcf87'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # rewrites every partition. jsonb can't hold NUL characters, so the
+    # few submissions that have them lose them. only real \u0000 escapes
+    # are removed, those after an even number of backslashes: in "\\u0000"
+    # the backslash is escaped, and the text is kept.
+    op.execute(r'''
+        ALTER TABLE submissions ALTER COLUMN data TYPE JSONB
+        USING regexp_replace(data::text, '(?<!\\)((?:\\\\)*)\\u0000', '\1', 'g')::jsonb
+    ''')
+    op.execute('CREATE INDEX ix_submissions_data '
+               'ON submissions USING gin (data jsonb_path_ops)')
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_submissions_data')
+    op.execute('ALTER TABLE submissions ALTER COLUMN data TYPE JSON USING data::json')
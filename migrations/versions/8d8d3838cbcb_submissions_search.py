@@ -0,0 +1,67 @@
+"""submissions search
+
+Revision ID: 8d8d3838cbcb
+Revises: 827c487de3a2
+Create Date: 2026-10-18 19:58:02.114530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d8d3838cbcb'
+down_revision = '827c487de3a2'
+
+import contextlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # everything here runs on a connection of its own, committed as it
+    # goes, so the index builds don't wait on this migration's transaction.
+    # the column is filled afterwards, in batches, by `flask backfill-search`.
+    with _autocommit() as connection:
+        # lets the form id be part of the GIN index, so searches only look
+        # at the matches of one form.
+        connection.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+        connection.execute('ALTER TABLE submissions ADD COLUMN IF NOT EXISTS search TSVECTOR')
+
+        # a partitioned table can't be indexed CONCURRENTLY, so each
+        # partition is, and their indexes are attached to the one of the
+        # table, that is only valid once all of them are. partitions created
+        # later get theirs from it.
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_submissions_search '
+                           'ON ONLY submissions USING gin (form_id, search)')
+        for partition, in connection.execute('''
+            SELECT inhrelid::regclass::text FROM pg_inherits
+            WHERE inhparent = 'submissions'::regclass
+        ''').fetchall():
+            name = 'ix_%s_search' % partition
+            # a build that failed midway leaves an invalid index behind.
+            if _is_invalid(connection, name):
+                connection.execute('DROP INDEX CONCURRENTLY %s' % name)
+            connection.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s '
+                               'ON %s USING gin (form_id, search)' % (name, partition))
+            connection.execute('ALTER INDEX ix_submissions_search '
+                               'ATTACH PARTITION %s' % name)
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_submissions_search')
+    op.execute('ALTER TABLE submissions DROP COLUMN search')
+
+
+@contextlib.contextmanager
+def _autocommit():
+    connection = op.get_bind().engine.connect()
+    try:
+        yield connection.execution_options(isolation_level='AUTOCOMMIT')
+    finally:
+        connection.close()
+
+
+def _is_invalid(connection, name):
+    return connection.execute(sa.text('''
+        SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        WHERE pg_class.relname = :name AND NOT pg_index.indisvalid
+    '''), name=name).scalar() is not None
@@ -0,0 +1,60 @@
+"""indexes for hot queries
+
+Revision ID: 90a965a263a4
+Revises: 9c0850acd9b5
+Create Date: 2026-10-18 15:21:09.366104
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '90a965a263a4'
+down_revision = '9c0850acd9b5'
+
+import contextlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+INDEXES = [
+    ('ix_submissions_form_id_id', 'submissions', 'form_id, id DESC'),
+    ('ix_forms_email', 'forms', 'email'),
+    ('ix_forms_owner_id', 'forms', 'owner_id'),
+    ('ix_emails_owner_id', 'emails', 'owner_id'),
+]
+
+
+def upgrade():
+    # CONCURRENTLY can't run inside a transaction, so the indexes are built
+    # on a connection of their own. the tables stay writable meanwhile. the
+    # migrations before this one are already committed (see
+    # transaction_per_migration in env.py), or the builds would wait on them.
+    with _autocommit() as connection:
+        for name, table, columns in INDEXES:
+            # a build that failed midway leaves an invalid index behind.
+            if _is_invalid(connection, name):
+                connection.execute('DROP INDEX CONCURRENTLY %s' % name)
+            connection.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)'
+                               % (name, table, columns))
+
+
+def downgrade():
+    with _autocommit() as connection:
+        for name, table, columns in reversed(INDEXES):
+            connection.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+
+
+@contextlib.contextmanager
+def _autocommit():
+    connection = op.get_bind().engine.connect()
+    try:
+        yield connection.execution_options(isolation_level='AUTOCOMMIT')
+    finally:
+        connection.close()
+
+
+def _is_invalid(connection, name):
+    return connection.execute(sa.text('''
+        SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        WHERE pg_class.relname = :name AND NOT pg_index.indisvalid
+    '''), name=name).scalar() is not None
@@ -0,0 +1,26 @@
+"""counter flushes
+
+Revision ID: 92c27f2c2e69
+Revises: 17fdc31bfb5e
+Create Date: 2026-10-18 23:02:51.730914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '92c27f2c2e69'
+down_revision = '17fdc31bfb5e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('counter_flushes',
+    sa.Column('id', sa.Text(), nullable=False),
+    sa.Column('flushed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('counter_flushes')
@@ -0,0 +1,45 @@
+"""form fields catalog
+
+Revision ID: 9c0850acd9b5
+Revises: 7732b0669b91
+Create Date: 2026-10-18 14:03:27.810442
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c0850acd9b5'
+down_revision = '7732b0669b91'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('form_fields',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('form_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('first_seen_at', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['form_id'], ['forms.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('form_id', 'name')
+    )
+
+    # fills the catalog of the existing forms in this transaction, so no
+    # submission is stored with a partial catalog (that would then hide the
+    # older fields). the keys are KEYS_NOT_STORED at this revision.
+    op.execute('''
+        INSERT INTO form_fields (form_id, name, first_seen_at, count)
+        SELECT form_id, key, coalesce(min(submitted_at), now() AT TIME ZONE 'utc'),
+               count(*)
+        FROM submissions, json_object_keys(data) AS key
+        WHERE key NOT IN ('_gotcha', '_format', '_language',
+                          'g-recaptcha-response', '_host_nonce')
+        GROUP BY form_id, key
+        ORDER BY min(submissions.id), key
+    ''')
+
+
+def downgrade():
+    op.drop_table('form_fields')
@@ -0,0 +1,35 @@
+"""archive segments
+
+Revision ID: e32b38be41d2
+Revises: 8d8d3838cbcb
+Create Date: 2026-10-18 20:36:54.271904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e32b38be41d2'
+down_revision = '8d8d3838cbcb'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('archive_segments',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('form_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.Text(), nullable=False),
+    sa.Column('first_submitted_at', sa.DateTime(), nullable=False),
+    sa.Column('last_submitted_at', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['form_id'], ['forms.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_archive_segments_form_id'), 'archive_segments', ['form_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_archive_segments_form_id'), table_name='archive_segments')
+    op.drop_table('archive_segments')
@@ -0,0 +1,100 @@
+"""partition submissions by month
+
+Revision ID: e5d644ebcf87
+Revises: 90a965a263a4
+Create Date: 2026-10-18 18:42:11.503218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5d644ebcf87'
+down_revision = '90a965a263a4'
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# needs PostgreSQL >= 11, and writes to submissions stopped while it runs.
+# the existing table becomes the partition of everything before the current
+# month, so only the submissions of this month on are copied. the rest is
+# scanned, to validate it and build the new indexes, but not rewritten.
+MONTHS_AHEAD = 3
+
+
+def upgrade():
+    now = datetime.datetime.utcnow()
+    boundary = _month_start(now)
+
+    # the partition key can't be null.
+    op.execute("""
+        UPDATE submissions SET submitted_at = now() AT TIME ZONE 'utc'
+        WHERE submitted_at IS NULL
+    """)
+    op.execute('ALTER TABLE submissions ALTER COLUMN submitted_at SET NOT NULL')
+    op.execute('ALTER TABLE submissions RENAME TO submissions_unpartitioned')
+    op.execute('ALTER INDEX submissions_pkey RENAME TO submissions_unpartitioned_pkey')
+    op.execute('DROP INDEX IF EXISTS ix_submissions_form_id_id')
+
+    op.execute('''
+        CREATE TABLE submissions (
+            id INTEGER NOT NULL DEFAULT nextval('submissions_id_seq'),
+            submitted_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            form_id INTEGER NOT NULL REFERENCES forms (id),
+            data JSON,
+            PRIMARY KEY (id, submitted_at)
+        ) PARTITION BY RANGE (submitted_at)
+    ''')
+    op.execute('ALTER SEQUENCE submissions_id_seq OWNED BY submissions.id')
+    op.execute('CREATE INDEX ix_submissions_form_id_submitted_at '
+               'ON submissions (form_id, submitted_at DESC, id DESC)')
+
+    month = boundary
+    while month <= _month_start(now, MONTHS_AHEAD):
+        op.execute('''
+            CREATE TABLE submissions_{year}_{month:02d} PARTITION OF submissions
+            FOR VALUES FROM ('{start}') TO ('{end}')
+        '''.format(year=month.year, month=month.month, start=month.isoformat(),
+                   end=_month_start(month, 1).isoformat()))
+        month = _month_start(month, 1)
+    # for the months the partitions weren't created for in time, see
+    # forms/partitions.py.
+    op.execute('CREATE TABLE submissions_default PARTITION OF submissions DEFAULT')
+
+    op.execute('''
+        INSERT INTO submissions (id, submitted_at, form_id, data)
+        SELECT id, submitted_at, form_id, data FROM submissions_unpartitioned
+        WHERE submitted_at >= '{boundary}'
+    '''.format(boundary=boundary.isoformat()))
+    op.execute("DELETE FROM submissions_unpartitioned WHERE submitted_at >= '%s'"
+               % boundary.isoformat())
+    # dropped by maintain_submission_partitions once it's past retention.
+    op.execute("ALTER TABLE submissions ATTACH PARTITION submissions_unpartitioned "
+               "FOR VALUES FROM (MINVALUE) TO ('%s')" % boundary.isoformat())
+
+
+def downgrade():
+    op.execute('ALTER TABLE submissions RENAME TO submissions_partitioned')
+    op.execute('ALTER INDEX submissions_pkey RENAME TO submissions_partitioned_pkey')
+    op.execute('''
+        CREATE TABLE submissions (
+            id INTEGER NOT NULL DEFAULT nextval('submissions_id_seq'),
+            submitted_at TIMESTAMP WITHOUT TIME ZONE,
+            form_id INTEGER NOT NULL REFERENCES forms (id),
+            data JSON,
+            CONSTRAINT submissions_pkey PRIMARY KEY (id)
+        )
+    ''')
+    op.execute('ALTER SEQUENCE submissions_id_seq OWNED BY submissions.id')
+    op.execute('''
+        INSERT INTO submissions (id, submitted_at, form_id, data)
+        SELECT id, submitted_at, form_id, data FROM submissions_partitioned
+    ''')
+    op.execute('DROP TABLE submissions_partitioned')
+    op.execute('CREATE INDEX ix_submissions_form_id_id '
+               'ON submissions (form_id, id DESC)')
+
+
+def _month_start(date, months=0):
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
@@ -9,6 +9,7 @@ from unittest.mock import patch, DEFAULT
 from formspree import settings
 from formspree.create_app import create_app
 from formspree.stuff import DB, redis_store, celery
+from formspree.forms import cache
 
 @pytest.fixture
 def worker():
@@ -26,6 +27,7 @@ def msend():
               patch('formspree.users.views.send_email', side_effect=side_effect), \
               patch('formspree.users.helpers.send_email', side_effect=side_effect), \
               patch('formspree.forms.models.send_email', side_effect=side_effect), \
+              patch('formspree.forms.helpers.send_email', side_effect=side_effect), \
               patch('formspree.forms.views.send_email', side_effect=side_effect):
             yield msend
 
@@ -35,7 +37,15 @@ def app():
     settings.ARCHIVED_SUBMISSIONS_LIMIT = 2
     settings.OVERLIMIT_NOTIFICATION_QUANTITY = 2
     settings.FORM_LIMIT_DECREASE_ACTIVATION_SEQUENCE = 0
-    settings.EXPENSIVELY_WIPE_SUBMISSIONS_FREQUENCY = 1
+    settings.EMAIL_OUTBOX = False
+    settings.SUBMISSIONS_STREAM = False
+    settings.SUBMISSIONS_RETENTION_MONTHS = 0
+    settings.SUBMISSIONS_ARCHIVE_STORE = None
+    settings.SUBMISSIONS_STREAM_BATCH = 1000
+    settings.SUBMISSION_COMPRESS_THRESHOLD = 4096
+    settings.FORMS_FILTER_REFRESH = -1
+    settings.FORMS_FILTER_MARGIN = 0
+    settings.TEMPLATE_RENDER_TIMEOUT = 5.0
     settings.PRESERVE_CONTEXT_ON_EXCEPTION = False
     settings.SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL')
     settings.STRIPE_PUBLISHABLE_KEY = settings.STRIPE_TEST_PUBLISHABLE_KEY
@@ -58,6 +68,7 @@ def client(app):
         DB.drop_all()
 
     redis_store.flushdb()
+    cache._forms_filter.update(filter=None, version=None, checked_at=0)
 
 def parse_confirmation_link_sent(email_text):
     matchlink = re.search('Link: ([^?]+)\?(\S+)', email_text)
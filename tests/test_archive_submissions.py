@@ -1,10 +1,20 @@
 import json
+import datetime
+
+import pytest
 
 from formspree import settings
-from formspree.stuff import DB
-from formspree.forms.helpers import HASH
+from formspree.stuff import DB, redis_store
+from formspree.forms.helpers import HASH, REDIS_RETENTION_PENDING_KEY, \
+                                   enforce_retention, flush_form_counters, \
+                                   maintain_submission_partitions
+from formspree.forms.partitions import month_start, create_partitions, \
+                                       existing_partitions, PARTITION_NAME, \
+                                       DEFAULT_PARTITION, LEGACY_PARTITION
 from formspree.users.models import User, Plan
-from formspree.forms.models import Form, Submission
+from formspree.forms.models import Form, Submission, FormField, ArchiveSegment
+from formspree.forms import archive
+from formspree.forms.cache import REDIS_FORM_FIELDS_KEY, new_form_fields
 
 def test_automatically_created_forms(client, msend):
     # submit a form
@@ -66,6 +76,8 @@ def test_automatically_created_forms(client, msend):
         headers = {'referer': 'http://somewhere.com'},
         data={'which-submission-is-this': 'the third!'}
     )
+    assert 3 == form.submissions.count()
+    enforce_retention()
     assert 2 == form.submissions.count()
     newest = form.submissions.first() # first should be the newest
     assert newest.data['which-submission-is-this'] == 'the third!'
@@ -74,6 +86,7 @@ def test_automatically_created_forms(client, msend):
         headers = {'referer': 'http://somewhere.com'},
         data={'which-submission-is-this': 'the fourth!'}
     )
+    enforce_retention()
     assert 2 == form.submissions.count()
     newest, last = form.submissions.all()
     assert newest.data['which-submission-is-this'] == 'the fourth!'
@@ -121,6 +134,7 @@ def test_automatically_created_forms(client, msend):
         headers = {'referer': 'http://here.com'},
         data={'name': 'husserl'}
     )
+    enforce_retention()
 
     assert 2 == secondform.submissions.count()
     newest, last = secondform.submissions.all()
@@ -136,6 +150,7 @@ def test_automatically_created_forms(client, msend):
         headers = {'referer': 'http://somewhere.com'},
         data={'which-submission-is-this': 'the fifth!'}
     )
+    enforce_retention()
     assert 2 == form.submissions.count()
     newest, last = form.submissions.all()
     assert newest.data['which-submission-is-this'] == 'the fifth!'
@@ -208,6 +223,19 @@ def test_gold_user_access(client, msend):
     assert lines[0] == "id,date,message,name"
     assert '"hi in my name is bruce!"', lines[1]
 
+    # a field missing from the catalog is left out, but doesn't break it
+    FormField.query.filter_by(name='message').delete()
+    DB.session.commit()
+    r = client.get('/forms/' + form_endpoint + '.csv')
+    lines = r.data.decode('utf-8').splitlines()
+    assert lines[0] == "id,date,name"
+    assert len(lines) == 2
+
+    r = client.get('/forms/' + form_endpoint + '.ndjson')
+    lines = r.data.decode('utf-8').splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['name'] == 'bruce'
+
     # test submissions endpoint with the user downgraded
     user.plan = Plan.free
     DB.session.add(user)
@@ -281,3 +309,359 @@ def test_grandfather_limit_and_decrease(client, msend):
     assert 'limit' in msend.call_args_list[-2][1]['text']
     assert 'new@example.com' == msend.call_args_list[-1][1]['to']
     assert 'limit' in msend.call_args_list[-1][1]['text']
+
+def test_paginated_submissions(client, msend):
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form_endpoint = json.loads(r.data.decode('utf-8'))['hashid']
+    form = Form.get_with_hashid(form_endpoint)
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+
+    for i in range(5):
+        client.post('/' + form_endpoint,
+            headers={'Referer': 'http://testsite.com'},
+            data={'n': str(i), 'message': 'hello %s' % i}
+        )
+
+    # the form itself can be fetched without its submissions
+    r = client.get('/api-int/forms/' + form_endpoint + '?submissions=false')
+    assert 'submissions' not in r.json
+
+    url = '/api-int/forms/' + form_endpoint + '/submissions'
+    r = client.get(url + '?limit=2')
+    assert r.json['fields'] == ['date', 'message', 'n']
+    assert [s['n'] for s in r.json['submissions']] == ['4', '3']
+
+    r = client.get(url + '?limit=2&before=%s' % r.json['next'])
+    assert [s['n'] for s in r.json['submissions']] == ['2', '1']
+
+    r = client.get(url + '?limit=2&before=%s' % r.json['next'])
+    assert [s['n'] for s in r.json['submissions']] == ['0']
+    assert r.json['next'] is None
+
+    # newer than a known submission, only some fields
+    first = r.json['submissions'][0]['id']
+    r = client.get(url + '?since=%s&fields=n' % (first + 2))
+    assert r.json['fields'] == ['date', 'n']
+    assert [sorted(s.keys()) for s in r.json['submissions']] == \
+        [['date', 'id', 'n']] * 2
+    assert [s['n'] for s in r.json['submissions']] == ['4', '3']
+
+    # with given values
+    r = client.get(url + '?where.message=hello%202')
+    assert [s['n'] for s in r.json['submissions']] == ['2']
+    r = client.get(url + '?where.message=hello%202&where.n=3')
+    assert r.json['submissions'] == []
+
+    # searching
+    r = client.get(url + '/search?q=hello%203')
+    assert [s['n'] for s in r.json['submissions']] == ['3']
+    r = client.get(url + '/search?q=hello&limit=3')
+    assert len(r.json['submissions']) == 3
+    assert r.json['next'] == 3
+    r = client.get(url + '/search?q=hello&limit=3&offset=3')
+    assert len(r.json['submissions']) == 2
+    assert r.json['next'] is None
+    r = client.get(url + '/search?q=goodbye')
+    assert r.json['submissions'] == []
+
+    # only for users that control the form
+    client.get('/logout')
+    r = client.get(url)
+    assert r.status_code == 401
+
+
+def test_form_fields_catalog(client, msend):
+    client.post('/alice@example.com',
+        headers = {'referer': 'http://somewhere.com'},
+        data={'name': 'john'}
+    )
+    form = Form.query.first()
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+
+    for data in [{'name': 'john', 'email': 'john@example.com'},
+                 {'name': 'jane', '_gotcha': ''},
+                 {'name': 'joe', 'age': '30', '_next': 'http://google.com'}]:
+        client.post('/alice@example.com',
+            headers = {'referer': 'http://somewhere.com'},
+            data=data
+        )
+
+    # fields are listed in the order they were first seen
+    assert form.submission_fields() == ['date', 'name', 'email', 'age', '_next']
+    # and remembered on Redis, so known ones aren't inserted again
+    assert redis_store.smembers(REDIS_FORM_FIELDS_KEY(form_id=form.id)) == \
+        {b'name', b'email', b'age', b'_next'}
+    assert new_form_fields(form.id, ['age', 'city', 'name']) == ['city']
+    # and counted on Redis, until flushed
+    assert {f.count for f in FormField.query.filter_by(form_id=form.id)} == {0}
+    flush_form_counters()
+    counts = {f.name: f.count for f in FormField.query.filter_by(form_id=form.id)}
+    assert counts == {'email': 1, 'name': 3, '_next': 1, 'age': 1}
+
+    # forms without a catalog get their fields from the submissions
+    FormField.query.delete()
+    DB.session.commit()
+    assert form.submission_fields() == ['date', '_next', 'age', 'email', 'name']
+
+
+def test_retention_per_plan_and_in_batches(client, msend, mocker):
+    mocker.patch.object(settings, 'ARCHIVED_SUBMISSIONS_PLAN_LIMITS', {Plan.gold: 5})
+    mocker.patch.object(settings, 'RETENTION_BATCH_SIZE', 1)
+    mocker.patch.object(settings, 'RETENTION_MAX_BATCHES', 2)
+
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form_endpoint = json.loads(r.data.decode('utf-8'))['hashid']
+    form = Form.get_with_hashid(form_endpoint)
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+    assert form.archive_limit == 5
+
+    for i in range(9):
+        client.post('/' + form_endpoint,
+            headers={'Referer': 'http://testsite.com'},
+            data={'n': str(i)}
+        )
+    assert 9 == form.submissions.count()
+    assert redis_store.smembers(REDIS_RETENTION_PENDING_KEY) == \
+        {str(form.id).encode('utf-8')}
+
+    # only two submissions are deleted per run, the form stays queued
+    enforce_retention()
+    assert 7 == form.submissions.count()
+    assert redis_store.sismember(REDIS_RETENTION_PENDING_KEY, form.id)
+
+    enforce_retention()
+    assert 5 == form.submissions.count()
+    assert [s.data['n'] for s in form.submissions] == ['8', '7', '6', '5', '4']
+
+    # downgraded forms fall back to the default limit
+    user.plan = Plan.free
+    DB.session.add(user)
+    DB.session.commit()
+    assert form.archive_limit == settings.ARCHIVED_SUBMISSIONS_LIMIT
+
+
+def test_old_submissions_move_to_cold_archive(client, msend, tmpdir, mocker):
+    mocker.patch.object(settings, 'ARCHIVED_SUBMISSIONS_PLAN_LIMITS', {Plan.gold: 3})
+    mocker.patch.object(settings, 'RETENTION_BATCH_SIZE', 2)
+    mocker.patch.object(settings, 'SUBMISSIONS_ARCHIVE_STORE', 'file://' + str(tmpdir))
+
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form_endpoint = json.loads(r.data.decode('utf-8'))['hashid']
+    form = Form.get_with_hashid(form_endpoint)
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+
+    for i in range(8):
+        client.post('/' + form_endpoint,
+            headers={'Referer': 'http://testsite.com'},
+            data={'n': str(i)}
+        )
+    enforce_retention()
+
+    # the oldest submissions left the table, in segments of a batch
+    assert [s.data['n'] for s in form.submissions] == ['7', '6', '5']
+    segments = ArchiveSegment.query.order_by(ArchiveSegment.id).all()
+    assert [segment.count for segment in segments] == [2, 2, 1]
+    assert len(tmpdir.listdir()) == 1  # forms/
+    assert len(tmpdir.join('forms', str(form.id)).listdir()) == 3
+
+    # but are still exported, after the others
+    r = client.get('/forms/' + form_endpoint + '.ndjson')
+    lines = r.data.decode('utf-8').splitlines()
+    assert [json.loads(line)['n'] for line in lines] == \
+        ['7', '6', '5', '4', '3', '2', '1', '0']
+
+    # and deleted with the form
+    client.delete('/api-int/forms/' + form_endpoint,
+                  headers={'Referer': settings.SERVICE_URL})
+    assert ArchiveSegment.query.count() == 0
+    assert tmpdir.join('forms', str(form.id)).listdir() == []
+
+
+def test_local_archive_store_must_be_shared(client, tmpdir):
+    archive.LocalStore('file://' + str(tmpdir.join('web'))).check()
+    archive.LocalStore('file://' + str(tmpdir.join('web'))).check()
+
+    # as when the worker has its own disk
+    with pytest.raises(RuntimeError):
+        archive.LocalStore('file://' + str(tmpdir.join('worker'))).check()
+
+
+def test_large_values_are_stored_compressed(client, msend):
+    settings.SUBMISSION_COMPRESS_THRESHOLD = 100
+
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form_endpoint = json.loads(r.data.decode('utf-8'))['hashid']
+    form = Form.get_with_hashid(form_endpoint)
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+
+    message = 'a long story about springs. ' * 50
+    client.post('/' + form_endpoint,
+        headers={'Referer': 'http://testsite.com'},
+        data={'name': 'hope', 'message': message}
+    )
+
+    # the long value is taken out of data, compressed, leaving its key
+    sub = Submission.query.first()
+    assert sub.data == {'name': 'hope', 'message': None}
+    assert sub.large is not None and len(sub.large) < len(message)
+    assert form.submission_fields() == ['date', 'message', 'name']
+
+    # and put back when read
+    url = '/api-int/forms/' + form_endpoint + '/submissions'
+    r = client.get(url)
+    assert r.json['submissions'][0]['message'] == message
+    r = client.get(url + '?fields=message')
+    assert r.json['submissions'][0]['message'] == message
+    r = client.get(url + '/search?q=springs')
+    assert r.json['submissions'][0]['message'] == message
+
+    r = client.get('/forms/' + form_endpoint + '.ndjson')
+    assert json.loads(r.data.decode('utf-8'))['message'] == message
+
+    # a field only ever sent large is still exported without the catalog
+    FormField.query.delete()
+    DB.session.commit()
+    assert form.submission_fields() == ['date', 'message', 'name']
+    r = client.get('/forms/' + form_endpoint + '.csv')
+    lines = r.data.decode('utf-8').splitlines()
+    assert lines[0] == 'id,date,message,name'
+    assert message.strip() in lines[1]
+
+
+def test_submissions_without_a_partition_are_kept(client, msend):
+    form = Form('hope@springs.com', host='testsite.com')
+    DB.session.add(form)
+    DB.session.commit()
+
+    # a month the partitions weren't created for
+    date = month_start(datetime.datetime.utcnow(), -5)
+    sub = Submission(form.id)
+    sub.submitted_at = date
+    sub.data = {'name': 'hope'}
+    DB.session.add(sub)
+    DB.session.commit()
+
+    def partition():
+        return DB.session.execute('SELECT tableoid::regclass::text '
+                                  'FROM submissions').scalar()
+
+    assert partition() == DEFAULT_PARTITION
+
+    # goes to its own partition when it is created
+    maintain_submission_partitions()
+    assert partition() == PARTITION_NAME(year=date.year, month=date.month)
+    assert [s.data for s in form.submissions] == [{'name': 'hope'}]
+
+
+def test_partitions_past_retention_are_dropped(client, msend):
+    settings.SUBMISSIONS_RETENTION_MONTHS = 2
+
+    form = Form('hope@springs.com', host='testsite.com')
+    DB.session.add(form)
+    DB.session.commit()
+
+    now = datetime.datetime.utcnow()
+    old = month_start(now, -3)
+    create_partitions(DB.session.connection(), old, old)
+    # the table from before partitioning holds everything older
+    DB.session.execute("CREATE TABLE %s PARTITION OF submissions "
+                       "FOR VALUES FROM (MINVALUE) TO ('%s')"
+                       % (LEGACY_PARTITION, old.isoformat()))
+    for date in [month_start(now, -12), old, now]:
+        sub = Submission(form.id)
+        sub.submitted_at = date
+        sub.data = {'date': date.isoformat()}
+        DB.session.add(sub)
+    DB.session.commit()
+
+    # submissions past the retention period aren't read anymore
+    submissions, _ = form.submissions_with_fields()
+    assert [s['id'] for s in submissions] == [form.submissions[0].id]
+
+    # and are gone with their partition
+    maintain_submission_partitions()
+    assert Submission.query.count() == 1
+    assert DB.session.execute('SELECT to_regclass(:name)',
+                              {'name': LEGACY_PARTITION}).scalar() is None
+    months = existing_partitions(DB.session.connection())
+    assert old not in months
+    assert month_start(now) in months
+    assert month_start(now, settings.SUBMISSIONS_PARTITIONS_AHEAD) in months
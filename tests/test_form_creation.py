@@ -1,8 +1,13 @@
 import json
 
+from sqlalchemy import event
+from flask_sqlalchemy import SignallingSession
+
 from formspree import settings
-from formspree.stuff import DB
+from formspree.stuff import DB, redis_store
 from formspree.forms.helpers import HASH
+from formspree.forms.cache import REDIS_FORM_KEY, REDIS_FORMS_FILTER_STATS_KEY
+from formspree.forms.helpers import rebuild_forms_filter
 from formspree.users.models import User, Email, Plan
 from formspree.forms.models import Form, Submission
 
@@ -439,3 +444,196 @@ def test_form_settings(client, msend):
         data=json.dumps({"captcha_disabled": False}),
     )
     assert not Form.query.first().captcha_disabled
+
+def test_form_features_follow_plan_changes(client, msend):
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form = Form.get_with_hashid(json.loads(r.data.decode('utf-8'))['hashid'])
+    assert form.controlled_by(user)
+    assert form.has_feature('dashboard')
+    assert not form.has_feature('whitelabel')
+
+    # cached features are dropped when the plan changes
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.commit()
+    assert form.has_feature('whitelabel')
+
+    user.plan = Plan.free
+    DB.session.add(user)
+    DB.session.commit()
+    assert not form.has_feature('dashboard')
+    assert form.features == set()
+
+    # and when a new address makes someone else a controller
+    other = User('hope@springs.com', 'banana')
+    other.plan = Plan.gold
+    DB.session.add(other)
+    DB.session.commit()
+    assert not form.controlled_by(other)
+
+    DB.session.add(Email(address='hope@springs.com', owner_id=other.id))
+    DB.session.commit()
+    assert form.controlled_by(other)
+    assert form.has_feature('dashboard')
+
+def test_confirmed_forms_are_cached(client, msend):
+    r = client.post('/register',
+        data={'email': 'colorado@springs.com',
+              'password': 'banana'}
+    )
+    user = User.query.filter_by(email='colorado@springs.com').first()
+    user.plan = Plan.gold
+    DB.session.add(user)
+    DB.session.commit()
+
+    r = client.post(
+        "/api-int/forms",
+        headers={
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "Referer": settings.SERVICE_URL,
+        },
+        data=json.dumps({"email": "hope@springs.com"}),
+    )
+    form_endpoint = json.loads(r.data.decode('utf-8'))['hashid']
+    form = Form.get_with_hashid(form_endpoint)
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+
+    # the first submission sets the host, the second caches the form
+    for name in ['bruce', 'wayne']:
+        r = client.post('/' + form_endpoint,
+            headers={'Referer': 'http://testsite.com'},
+            data={'name': name}
+        )
+        assert r.status_code == 302
+    assert redis_store.get(REDIS_FORM_KEY(form_id=form.id))
+
+    # forms are rebuilt from the cache
+    DB.session.expunge_all()
+    cached = Form.get_with_hashid(form_endpoint, cached=True)
+    assert cached.host == 'testsite.com'
+    assert cached.confirmed
+    assert cached.has_feature('dashboard')
+    assert cached.counter == 2
+
+    # and dropped from it when they change
+    client.patch(
+        "/api-int/forms/" + form_endpoint,
+        headers={"Referer": settings.SERVICE_URL},
+        content_type="application/json",
+        data=json.dumps({"disabled": True}),
+    )
+    assert not redis_store.get(REDIS_FORM_KEY(form_id=form.id))
+
+    r = client.post('/' + form_endpoint,
+        headers={'Referer': 'http://testsite.com'},
+        data={'name': 'robin'}
+    )
+    assert r.status_code == 403
+
+
+def test_unknown_forms_are_rejected_without_queries(client, msend):
+    for email in ['one@springs.com', 'two@springs.com', 'three@springs.com']:
+        DB.session.add(Form(email, host='testsite.com'))
+    DB.session.commit()
+    gone = Form.query.filter_by(email='two@springs.com').first()
+    DB.session.delete(gone)
+    DB.session.commit()
+
+    rebuild_forms_filter()
+    DB.session.expunge_all()
+
+    # existing forms pass the filter
+    for form in Form.query.all():
+        assert Form.get_cached(form.id).email == form.email
+    DB.session.expunge_all()
+
+    # ids ruled out by the filter never reach the database
+    assert Form.get_cached(gone.id) is None
+
+    # newer ids do, and then get remembered as missing for a while
+    assert Form.get_cached(gone.id + 2) is None
+    assert Form.get_cached(gone.id + 2) is None
+
+    stats = redis_store.hgetall(REDIS_FORMS_FILTER_STATS_KEY)
+    assert stats == {b'filter': b'1', b'database': b'1', b'negative_cache': b'1'}
+
+    # until a form with that id is created
+    DB.session.add(Form('four@springs.com', host='testsite.com'))
+    DB.session.commit()
+    DB.session.expunge_all()
+    assert Form.get_cached(gone.id + 2).email == 'four@springs.com'
+
+
+def test_one_commit_per_submission(client, msend):
+    commits = []
+    def count_commit(session):
+        commits.append(session)
+
+    # DB.session (a scoped_session) can't have listeners itself.
+    event.listen(SignallingSession, 'after_commit', count_commit)
+    try:
+        # a new form is created and asked for confirmation
+        r = client.post('/hope@springs.com',
+            headers={'Referer': 'http://testsite.com'},
+            data={'name': 'bruce'}
+        )
+        assert 'one step away' in msend.call_args[1]['text']
+        assert len(commits) == 1
+        form = Form.query.first()
+        assert form.confirm_sent
+        assert form.uses_ajax is False
+
+        # submissions to a confirmed form
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        del commits[:]
+        for name in ['wayne', 'robin']:
+            client.post('/hope@springs.com',
+                headers={'Referer': 'http://testsite.com'},
+                data={'name': name}
+            )
+        assert len(commits) == 2
+        assert form.submissions.count() == 2
+
+        # a dashboard form gets its host with the first submission
+        user = User('hope@springs.com', 'banana')
+        DB.session.add(user)
+        DB.session.commit()
+        form = Form('hope@springs.com', owner=user)
+        form.confirmed = True
+        form.uses_ajax = None
+        DB.session.add(form)
+        DB.session.commit()
+        del commits[:]
+        client.post('/' + form.hashid,
+            headers={'Referer': 'http://othersite.com'},
+            data={'name': 'alfred'}
+        )
+        assert len(commits) == 1
+        form = Form.query.get(form.id)
+        assert form.host == 'othersite.com'
+        assert form.uses_ajax is False
+        assert form.submissions.count() == 1
+    finally:
+        event.remove(SignallingSession, 'after_commit', count_commit)
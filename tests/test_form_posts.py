@@ -1,6 +1,15 @@
+import json
+import datetime
+import pytest
+
 from formspree import settings
-from formspree.stuff import DB
-from formspree.forms.models import Form
+from formspree.stuff import DB, redis_store
+from formspree.forms import quota, counters, ingest
+from formspree.forms.cache import invalidate_forms
+from formspree.forms.models import Form, FormField, OutboxEmail, EmailTemplate
+from formspree.forms.helpers import deliver_outbox_email, flush_form_counters, \
+                                    ingest_submissions, ZSTD_MAGIC, \
+                                    REDIS_FIRSTSUBMISSION_KEY
 from formspree.users.models import User, Email, Plan
 
 http_headers = {
@@ -310,3 +319,293 @@ def test_first_submission_is_stored(client, msend):
 
     # got the first (missed) submission
     assert 'this was important' in msend.call_args[1]['text']
+
+def test_large_submissions_are_compressed(client, msend):
+    settings.SUBMISSION_COMPRESS_THRESHOLD = 100
+    story = 'a long story about a galaxy far away. ' * 50
+
+    # the first submission waits compressed on Redis
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke', 'story': story}
+    )
+    f = Form.query.first()
+    assert redis_store.get(REDIS_FIRSTSUBMISSION_KEY(nonce=f.hash)) \
+        .startswith(ZSTD_MAGIC)
+    client.get('/confirm/%s' % (f.hash,))
+    assert story in msend.call_args[1]['text']
+
+    # and so do those going through the stream
+    settings.SUBMISSIONS_STREAM = True
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'leia', 'story': story}
+    )
+    ingest_submissions()
+
+    for sub in f.submissions:
+        assert sub.data['story'] is None and sub.large is not None
+    submissions, fields = f.submissions_with_fields()
+    assert [s['story'] for s in submissions] == [story, story]
+    assert fields == ['date', 'name', 'story']
+
+def test_submission_through_outbox(client, msend, mocker):
+    settings.EMAIL_OUTBOX = True
+    mdeliver = mocker.patch('formspree.forms.models.deliver_outbox_email.delay')
+
+    r = client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke'}
+    )
+    f = Form.query.first()
+    f.confirmed = True
+    DB.session.add(f)
+    DB.session.commit()
+
+    msend.reset_mock()
+    r = client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'leia'}
+    )
+    assert r.status_code == 302
+
+    # the submission was stored and the emails queued, but not sent yet:
+    # the quota warning (the limit is 2 during tests) and the submission
+    assert not msend.called
+    assert f.submissions.count() == 1
+    warning, outbox = OutboxEmail.query.order_by(OutboxEmail.id).all()
+    assert warning.form_id == outbox.form_id == f.id
+    assert outbox.sent_at is None
+    assert [c[0][0] for c in mdeliver.call_args_list] == [warning.id, outbox.id]
+
+    # the worker delivers them
+    deliver_outbox_email(warning.id)
+    assert '90%' in msend.call_args[1]['text']
+    deliver_outbox_email(outbox.id)
+    assert 'leia' in msend.call_args[1]['text']
+    outbox = OutboxEmail.query.get(outbox.id)
+    assert outbox.sent_at is not None
+    assert outbox.attempts == 1
+
+    # and won't deliver them again
+    msend.reset_mock()
+    deliver_outbox_email(outbox.id)
+    assert not msend.called
+
+    # emails send_email refuses fail for good, instead of staying pending
+    mocker.patch('formspree.forms.helpers.send_email',
+                 side_effect=ValueError('to, subject text and sender required'))
+    broken = OutboxEmail(f.id, dict(outbox.message, subject=None))
+    DB.session.add(broken)
+    DB.session.commit()
+    deliver_outbox_email(broken.id)
+    broken = OutboxEmail.query.get(broken.id)
+    assert broken.failed_at is not None
+    assert 'ValueError' in broken.error
+
+def test_submissions_through_stream(client, msend, mocker):
+    r = client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke'}
+    )
+    f = Form.query.first()
+    f.confirmed = True
+    DB.session.add(f)
+    DB.session.commit()
+
+    settings.SUBMISSIONS_STREAM = True
+    for name in ['leia', 'han', 'chewie']:
+        r = client.post('/luke@testwebsite.com',
+            headers=http_headers,
+            data={'name': name, 'ship': 'falcon'}
+        )
+        assert r.status_code == 302
+
+    # the emails went out, but nothing was written yet
+    assert 'chewie' in msend.call_args[1]['text']
+    assert f.submissions.count() == 0
+
+    # the worker writes them all at once
+    settings.SUBMISSIONS_STREAM_BATCH = 2
+    ingest_submissions()
+    assert [s.data['name'] for s in f.submissions] == ['chewie', 'han', 'leia']
+    assert {field.name: field.count for field in
+            FormField.query.filter_by(form_id=f.id)} == {'name': 3, 'ship': 3}
+
+    # and acknowledged them, so they aren't written again
+    ingest_submissions()
+    assert f.submissions.count() == 3
+
+    # batches committed but not acknowledged are read again, and skipped
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'lando', 'ship': 'falcon'}
+    )
+    mocker.patch('formspree.forms.ingest.ack', side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        ingest_submissions()
+    assert f.submissions.count() == 4
+    mocker.stopall()
+    ingest_submissions()
+    assert f.submissions.count() == 4
+    assert redis_store.execute_command(
+        'XLEN', ingest.REDIS_SUBMISSIONS_STREAM_KEY) == 0
+
+def test_custom_template_falls_back_to_default(client, msend):
+    user = User('luke@testwebsite.com', 'banana')
+    user.plan = Plan.platinum
+    DB.session.add(user)
+    DB.session.commit()
+    DB.session.add(Email(address='luke@testwebsite.com', owner_id=user.id))
+    DB.session.commit()
+
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke'}
+    )
+    f = Form.query.first()
+    f.confirmed = True
+    template = EmailTemplate(f.id)
+    template.from_name = 'Rebels'
+    template.subject = 'Message from {{ _host }}'
+    template.style = 'h1 { color: red; }'
+    template.body = '<h1>Custom!</h1>{{#_fields}}<p>{{_value}}</p>{{/_fields}}'
+    DB.session.add(f)
+    DB.session.add(template)
+    DB.session.commit()
+
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'leia'}
+    )
+    assert 'Custom!' in msend.call_args[1]['html']
+    assert '<p>leia</p>' in msend.call_args[1]['html']
+    assert msend.call_args[1]['subject'] == 'Message from testwebsite.com'
+
+    # templates that take too long are replaced by the default one
+    settings.TEMPLATE_RENDER_TIMEOUT = 0
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'han'}
+    )
+    assert 'Custom!' not in msend.call_args[1]['html']
+    assert 'han' in msend.call_args[1]['html']
+
+def test_monthly_quota(client):
+    month = datetime.datetime.now().replace(day=1)
+    statuses = [quota.consume(1, 10, 2, month)[1] for _ in range(13)]
+    assert statuses == ['ok'] * 8 + ['warning', 'ok'] + \
+        ['overlimit'] * 2 + ['reject']
+    assert quota.monthly_count(1, month) == 13
+
+    # counters don't carry over to the same month of the next year
+    next_year = month.replace(year=month.year + 1)
+    assert quota.consume(1, 10, 2, next_year) == (1, 'ok')
+
+    # counters from before years were counted are picked up
+    redis_store.set('monthly_2_%s' % month.month, 5)
+    assert quota.monthly_count(2, month) == 5
+    assert quota.consume(2, 10, 2, month) == (6, 'ok')
+
+    # forms with unlimited submissions are never over the limit
+    for _ in range(20):
+        assert quota.consume(3, None, 2, month)[1] == 'ok'
+
+def test_hard_overlimit_forms_are_rejected_early(client, msend, mocker):
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke'}
+    )
+    f = Form.query.first()
+    f.confirm_sent = True
+    f.confirmed = True
+    DB.session.add(f)
+    DB.session.commit()
+
+    # limit (2) + overlimit notifications (2) + the first rejected one
+    for i in range(5):
+        client.post('/luke@testwebsite.com',
+            headers=http_headers,
+            data={'name': 'matthew'}
+        )
+    assert quota.is_hard_overlimit(f.id)
+    assert f.get_monthly_counter() == 6
+
+    # from now on the database and the counters aren't touched
+    query = mocker.spy(Form, 'get_with_hash')
+    r = client.post('/luke@testwebsite.com',
+        headers={'Referer': 'testwebsite.com', 'Accept': 'application/json'},
+        data={'name': 'matthew'}
+    )
+    assert json.loads(r.data.decode('utf-8'))['error'] == 'form over quota'
+    assert query.call_count == 0
+    assert f.get_monthly_counter() == 6
+
+    # upgrading the owner lifts the rejection
+    invalidate_forms(f.id)
+    assert not quota.is_hard_overlimit(f.id)
+
+
+def test_counters_are_buffered_and_flushed(client, msend, mocker):
+    # every submission below reaches Form.send, none is rejected early
+    settings.MONTHLY_SUBMISSIONS_LIMIT = 100  # reset by the app fixture
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'luke'}
+    )
+    f = Form.query.first()
+    f.confirm_sent = True
+    f.confirmed = True
+    DB.session.add(f)
+    DB.session.commit()
+
+    for i in range(3):
+        client.post('/luke@testwebsite.com',
+            headers=http_headers,
+            data={'name': 'matthew'}
+        )
+
+    # the row isn't updated on every submission
+    f = Form.query.first()
+    assert f.stored_counter == 0
+    assert f.counter == 3
+
+    flush_form_counters()
+    f = Form.query.first()
+    assert f.stored_counter == 3
+    assert f.counter == 3
+
+    # nothing left to flush
+    flush_form_counters()
+    assert Form.query.first().counter == 3
+
+    # a flush committed but not cleared from Redis isn't counted twice,
+    # neither when reading the counter nor when it's retried
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'mark'}
+    )
+    mocker.patch('formspree.forms.counters.flushed', side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        flush_form_counters()
+    f = Form.query.first()
+    assert f.stored_counter == 4
+    assert f.counter == 4
+
+    mocker.stopall()
+    flush_form_counters()
+    assert Form.query.first().counter == 4
+    assert Form.query.first().stored_counter == 4
+
+    # and flushes don't overlap
+    client.post('/luke@testwebsite.com',
+        headers=http_headers,
+        data={'name': 'john'}
+    )
+    lock = counters.flush_lock(10)
+    assert lock.acquire(blocking=False)
+    flush_form_counters()
+    assert Form.query.first().stored_counter == 4
+    lock.release()
+    flush_form_counters()
+    assert Form.query.first().stored_counter == 5
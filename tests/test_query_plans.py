@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+from formspree.stuff import DB
+from formspree.forms.partitions import PARTITION_NAME, month_start
+
+# the queries behind Form.submissions, retention, submission filters and
+# searches, User.forms, Form.controllers and unconfirm_form, with the index
+# each must use.
+# (the indexes of the submissions partitions are named after their columns)
+HOT_QUERIES = [
+    ('form_id_submitted_at_id_idx',
+     'SELECT id FROM submissions WHERE form_id = 1 '
+     'ORDER BY submitted_at DESC, id DESC LIMIT 10'),
+    ('data_idx',
+     """SELECT id FROM submissions WHERE data @> '{"email": "alice@example.com"}'"""),
+    ('form_id_search_idx',
+     "SELECT id FROM submissions WHERE form_id = 1 "
+     "AND search @@ websearch_to_tsquery('simple', 'alice')"),
+    ('ix_forms_email',
+     "SELECT id FROM forms WHERE email = 'alice@example.com'"),
+    ('ix_forms_owner_id',
+     'SELECT id FROM forms WHERE owner_id = 1'),
+    ('ix_emails_owner_id',
+     'SELECT address FROM emails WHERE owner_id = 1'),
+]
+
+@pytest.mark.parametrize('index,query', HOT_QUERIES)
+def test_hot_queries_use_indexes(client, index, query):
+    # the test tables are tiny, so sequential scans must be ruled out
+    # for the planner to show which index it would pick.
+    DB.session.execute('SET LOCAL enable_seqscan = off')
+    plan = '\n'.join(line for line, in DB.session.execute('EXPLAIN ' + query))
+    DB.session.rollback()
+
+    assert index in plan
+
+
+def test_submission_dates_prune_partitions(client):
+    this_month = month_start(datetime.datetime.utcnow())
+    next_month = month_start(this_month, 1)
+    plan = '\n'.join(line for line, in DB.session.execute(
+        "EXPLAIN SELECT id FROM submissions WHERE form_id = 1 "
+        "AND submitted_at >= '%s'" % next_month.isoformat()))
+    DB.session.rollback()
+
+    assert PARTITION_NAME(year=next_month.year, month=next_month.month) in plan
+    assert PARTITION_NAME(year=this_month.year, month=this_month.month) not in plan
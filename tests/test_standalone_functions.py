@@ -1,4 +1,11 @@
-from formspree.utils import next_url
+from flask import render_template, render_template_string
+
+from formspree import settings
+from formspree.stuff import TEMPLATES
+from formspree.template import inlined_mustache, render_whitelabel, \
+                               generate_templates
+from formspree.forms.models import EmailTemplate
+from formspree.utils import next_url, http_session, http_pool_stats
 from formspree.users.helpers import send_downgrade_email
 
 def test_next_url(client):
@@ -25,3 +32,56 @@ def test_send_downgrade_email(msend):
     assert msend.called
     assert msend.call_args[1]['to'] == 'whatever@example.com'
     assert 'Successfully downgraded from' in msend.call_args[1]['subject']
+
+def test_http_session_is_shared_and_pooled():
+    session = http_session()
+    assert http_session() is session
+
+    adapter = session.get_adapter('https://api.sendgrid.com/api/mail.send.json')
+    assert adapter._pool_maxsize == settings.HTTP_POOL_MAXSIZE
+    assert isinstance(http_pool_stats(), dict)
+
+def test_inlined_templates_are_registered(client):
+    context = dict(data={'name': 'Alice'}, keys=['name'], host='example.com',
+                   now='just now', unconfirm_url='#')
+    html = render_template('email/inlined/form.html', **context)
+    assert html == render_template_string(TEMPLATES['form.html'], **context)
+    assert 'Alice' in html
+
+def test_whitelabel_templates_are_inlined_once():
+    style = 'h1 { color: red; } td { padding: 2px; }'
+    body = '<h1>{{ _host }}</h1><table>{{#_fields}}<tr><td>{{_name}}</td>' \
+           '<td>{{_value}}</td></tr>{{/_fields}}</table>' \
+           '<a href="http://{{ _host }}">{{& _time }}</a>'
+
+    inlined_mustache.cache_clear()
+    for _ in range(2):
+        html, subject = render_whitelabel(
+            'New submission from {{ _host }}', style, body, {
+                '_host': 'example.com/', '_time': '10:00 AM UTC',
+                '_fields': [{'_name': '_replyto', '_value': 'i.jones@example.com'}]
+            })
+        assert subject == 'New submission from example.com/'
+        assert '<h1 style="color:red">example.com/</h1>' in html
+        assert '<td style="padding:2px">_replyto</td>' in html
+        assert '<td style="padding:2px">i.jones@example.com</td>' in html
+        assert 'href="http://example.com/"' in html
+        assert 'UTC' in html
+    assert inlined_mustache.cache_info().hits == 1
+
+    # structural selectors are applied to the rendered email
+    style = 'tr:first-child td { color: blue; }'
+    html, _ = EmailTemplate.make_sample(style, body)
+    assert inlined_mustache(style, body) is None
+    assert html.count('style="color:blue"') == 2
+
+def test_inlined_templates_are_cached_on_disk(tmpdir, mocker):
+    cache = str(tmpdir.join('inlined.json'))
+    mocker.patch.object(settings, 'EMAIL_TEMPLATES_CACHE', cache)
+
+    templates = generate_templates()
+    assert templates == TEMPLATES
+
+    # the next boot doesn't need premailer
+    mocker.patch('premailer.Premailer', side_effect=Exception)
+    assert generate_templates() == templates